@@ -0,0 +1,43 @@
+"""Compares Activator.bind_many with one by one bind calls
+
+Usage: python benchmarks/startup.py [actions-count]
+"""
+import sys
+from time import time
+
+from uxie.actions import KeyMap
+
+def make_rows(count, menu_size=50):
+    rows = []
+    for i in range(count):
+        rows.append(('ctx%d' % (i % 10), 'action-%d' % i,
+            'Menu%d/Sub%d/Action %d' % (i / menu_size / 10, i / menu_size, i),
+            None, '<ctrl><alt>F%d' % (i % 12 + 1)))
+
+    return rows
+
+def bind_one_by_one(activator, rows):
+    # Accels are a string or a list of (accel, priority) like in bind_many
+    for ctx, name, menu_entry, callback, accels in rows:
+        binder = activator.bind(ctx, name, menu_entry, callback)
+        if isinstance(accels, str):
+            binder.to(accels)
+        else:
+            for accel, priority in accels:
+                binder.to(accel, priority)
+
+def bind_many(activator, rows):
+    activator.bind_many(rows)
+
+def measure(func, rows):
+    activator = KeyMap().get_activator()
+    t = time()
+    func(activator, rows)
+    return time() - t
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rows = make_rows(count)
+
+    for func in (bind_one_by_one, bind_many):
+        print '%-16s %d actions: %.3fs' % (func.__name__, count, measure(func, rows))
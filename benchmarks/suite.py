@@ -0,0 +1,217 @@
+"""Activator scalability benchmarks
+
+Generates synthetic keymaps and measures bind throughput, activation
+latency, get_km_for_action and actions menu build time. Results are
+written as JSON so they can be compared between releases.
+
+Usage: python benchmarks/suite.py [-n ACTIONS] [-m CONTEXTS] [-k CONFLICTS] [-o FILE]
+
+Starts Xvfb if there is no DISPLAY.
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import subprocess
+
+def start_xvfb(display=':99'):
+    proc = subprocess.Popen(['Xvfb', display, '-screen', '0', '1024x768x24'],
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    time.sleep(1)
+    os.environ['DISPLAY'] = display
+    return proc
+
+def percentiles(values):
+    values = sorted(values)
+    get = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+    return {
+        'count': len(values),
+        'min': values[0],
+        'median': get(0.5),
+        'p95': get(0.95),
+        'max': values[-1],
+        'avg': sum(values) / len(values),
+    }
+
+MODS = ('<ctrl>', '<alt>', '<ctrl><alt>', '<ctrl><shift>', '<alt><shift>', '<ctrl><alt><shift>')
+KEYS = [m + k for m in MODS for k in list('abcdefghijklmnopqrstuvwxyz') +
+    ['F%d' % i for i in range(1, 13)]]
+SHARED_KEYS = KEYS[:12]
+SINGLE_KEYS = KEYS[12:120]
+PREFIX_KEYS = KEYS[120:]
+
+def make_accels(count, rnd):
+    # Single keys and sequence prefixes don't overlap, so no accelerator
+    # is bound twice or shadows a sequence
+    accels = SINGLE_KEYS + ['%s %s' % (p, k) for p in PREFIX_KEYS for k in KEYS]
+    if count > len(accels):
+        raise ValueError('At most %d unique accelerators are available' % len(accels))
+
+    rnd.shuffle(accels)
+    return accels[:count]
+
+def make_keymap(actions, contexts, conflicts, chain=5, seed=1):
+    """Returns (contexts, rows)
+
+    Contexts form dependency chains of ``chain`` length, every 3rd chain
+    resolves to None. First ``conflicts`` actions share SHARED_KEYS with
+    distinct priorities, so activation walks several tiers without
+    ambiguity. The rest have unique single keys or two key sequences.
+    """
+    rnd = random.Random(seed)
+    ctxs = []
+    for i in range(contexts):
+        name = 'ctx%d' % i
+        if i % chain:
+            ctxs.append((name, 'ctx%d' % (i - 1), lambda parent: parent))
+        elif (i / chain) % 3 == 2:
+            ctxs.append((name, None, lambda: None))
+        else:
+            ctxs.append((name, None, lambda: object()))
+
+    conflicts = min(conflicts, actions)
+    accels = make_accels(actions - conflicts, rnd)
+
+    rows = []
+    for i in range(actions):
+        if i < conflicts:
+            accel = [(SHARED_KEYS[i % len(SHARED_KEYS)], i)]
+        else:
+            accel = accels[i - conflicts]
+
+        rows.append(('ctx%d' % rnd.randrange(contexts), 'action-%d' % i,
+            'Menu%d/Sub%d/Action %d' % (i % 20, i % 200, i), lambda *args: None, accel))
+
+    return ctxs, rows
+
+def create_activator(ctxs, rows=None):
+    from uxie.actions import KeyMap
+
+    activator = KeyMap().get_activator()
+    for name, depends, callback in ctxs:
+        activator.add_context(name, depends, callback)
+
+    if rows:
+        activator.bind_many(rows)
+
+    return activator
+
+def bench_bind(rows):
+    import startup
+
+    return {
+        'bind_per_sec': len(rows) / startup.measure(startup.bind_one_by_one, rows),
+        'bind_many_per_sec': len(rows) / startup.measure(startup.bind_many, rows),
+    }
+
+def bench_activate(activator, window, rows, count=2000):
+    from uxie.actions import parse_accel, is_sequence
+
+    keys = []
+    for row in rows[:count]:
+        accel = row[4] if isinstance(row[4], str) else row[4][0][0]
+        km = parse_accel(accel)[0]
+        keys.append(km[0] if is_sequence(km) else km)
+
+    timings = []
+    for key, mod in keys:
+        t = time.time()
+        activator.activate(None, window, key, mod)
+        timings.append(time.time() - t)
+        activator.cancel_sequence(window)
+
+    return percentiles(timings)
+
+def bench_get_km(activator, rows):
+    from uxie.actions import normalize_context
+
+    timings = []
+    for ctx, name, _, _, _ in rows:
+        ctx = normalize_context(ctx)
+        t = time.time()
+        activator.get_km_for_action(ctx, name)
+        timings.append(time.time() - t)
+
+    return percentiles(timings)
+
+def bench_menu(activator, window, paths):
+    from uxie.actions import fill_menu
+
+    result = {}
+    for kind in ('cold', 'warm'):
+        timings = []
+        for path in paths:
+            ctx_getter = activator.make_context_getter(window)
+            t = time.time()
+            actions = activator.menu.get_entry_for_path(path).get_entries(ctx_getter)
+            fill_menu(activator.get_menu(path), window, activator, ctx_getter, actions)
+            timings.append(time.time() - t)
+
+        result[kind] = percentiles(timings)
+
+    activator.clear_menus()
+    return result
+
+def run(actions, contexts, conflicts):
+    import gtk
+
+    ctxs, rows = make_keymap(actions, contexts, conflicts)
+    results = {'bind': bench_bind(rows)}
+
+    window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+    window.show()
+    activator = create_activator(ctxs, rows)
+    activator.attach(window)
+
+    results['activate'] = bench_activate(activator, window, rows)
+    results['get_km_for_action'] = bench_get_km(activator, rows)
+    # Sub menus exist only for generated actions
+    results['actions_menu'] = bench_menu(activator, window,
+        [''] + ['Menu%d/Sub%d' % (i % 20, i) for i in range(0, min(200, actions), 10)])
+
+    window.destroy()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Activator benchmarks')
+    parser.add_argument('-n', '--actions', type=int, default=5000)
+    parser.add_argument('-m', '--contexts', type=int, default=50)
+    parser.add_argument('-k', '--conflicts', type=int, default=100)
+    parser.add_argument('-o', '--output', help='Result file, stdout by default')
+    parser.add_argument('--no-xvfb', action='store_true', help="Don't start Xvfb")
+    args = parser.parse_args()
+
+    xvfb = None
+    if not os.environ.get('DISPLAY') and not args.no_xvfb:
+        xvfb = start_xvfb()
+
+    try:
+        results = run(args.actions, args.contexts, args.conflicts)
+    finally:
+        if xvfb:
+            xvfb.terminate()
+
+    data = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'params': {
+            'actions': args.actions,
+            'contexts': args.contexts,
+            'conflicts': args.conflicts,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    else:
+        json.dump(data, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
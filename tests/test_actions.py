@@ -0,0 +1,390 @@
+from uxie.actions import KeyMap, parse_accel
+from uxie.keymap import parse_key
+
+
+class Window(object):
+    last_shortcut = None
+
+
+def activate(activator, accel, window=None):
+    key, mod = parse_key(accel)
+    return activator.activate(None, window or Window(), key, mod)
+
+def test_activate_picks_top_priority_tier():
+    activator = KeyMap().get_activator()
+    calls = []
+
+    activator.bind('any', 'low', None, calls.append, 'low').to('<ctrl>a')
+    activator.bind('any', 'high', None, calls.append, 'high').to('<ctrl>a', 10)
+    activator.add_context('missing', None, lambda: None)
+    activator.bind('missing', 'top', None, calls.append, 'top').to('<ctrl>a', 20)
+
+    activate(activator, '<ctrl>a')
+    assert calls == ['high']
+
+def test_dispatch_is_updated_on_rebind():
+    activator = KeyMap().get_activator()
+    calls = []
+
+    activator.bind('any', 'action', None, calls.append, 'first').to('<ctrl>a')
+    activate(activator, '<ctrl>a')
+
+    activator.bind('any', 'action', None, calls.append, 'second')
+    activate(activator, '<ctrl>a')
+
+    activator.replace_keys(('any',), 'action', [(parse_key('<ctrl>b'), 0)])
+    activate(activator, '<ctrl>b')
+    assert calls == ['first', 'second', 'second']
+
+def test_activate_dynamic_action():
+    activator = KeyMap().get_activator()
+    calls = []
+
+    def resolver(param):
+        return calls.append, (param,), param
+
+    activator.bind_dynamic('any', 'dyn', None, None, resolver)
+    activator.map('any', '!dyn/foo', '<ctrl>d')
+    activate(activator, '<ctrl>d')
+    assert calls == ['foo']
+
+def test_cached_dynamic_entries():
+    activator = KeyMap().get_activator()
+    buf = Window()
+    activator.add_context('buffer', None, lambda: buf)
+    calls = []
+
+    def generator(buf):
+        calls.append('generate')
+        return [('Foo', 'foo', (calls.append, ('foo',)))]
+
+    def resolver(buf, param):
+        calls.append('resolve')
+        return calls.append, (param,), param
+
+    activator.bind_dynamic('buffer', 'dyn', None, generator, resolver, invalidate_on='buffers')
+    activator.map('buffer', '!dyn/foo', '<ctrl>d')
+    entry = activator.actions[('buffer',)]['!dyn']
+    ctx_getter = activator.make_context_getter(Window())
+
+    e1 = entry.get_entries(ctx_getter)
+    e2 = entry.get_entries(ctx_getter)
+    assert e1 is e2
+    activate(activator, '<ctrl>d')
+    activate(activator, '<ctrl>d')
+    assert calls == ['generate', 'resolve', 'foo', 'foo']
+
+    calls[:] = []
+    activator.invalidate_context('buffers')
+    entry.get_entries(ctx_getter)
+    activate(activator, '<ctrl>d')
+    assert calls == ['generate', 'resolve', 'foo']
+
+    calls[:] = []
+    buf = Window()
+    entry.get_entries(activator.make_context_getter(Window()))
+    assert calls == ['generate']
+
+def test_dynamic_cache_contexts():
+    from uxie.actions import DynamicCache
+
+    cache = DynamicCache()
+    cache.set((), 'key', 'any')
+    assert cache.get((), 'key') == 'any'
+
+    obj = Window()
+    cache.set((obj, 1), 'key', 'obj')
+    assert cache.get((obj, 1), 'key') == 'obj'
+    try:
+        cache.get((obj, 2), 'key')
+        assert False
+    except KeyError:
+        pass
+
+    try:
+        cache.set(('not weakrefable',), 'key', 'value')
+        assert False
+    except TypeError:
+        pass
+
+    cache.clear()
+    try:
+        cache.get((), 'key')
+        assert False
+    except KeyError:
+        pass
+
+def test_get_km_for_action():
+    activator = KeyMap().get_activator()
+    activator.bind('any', 'action', None, None).to('<ctrl>a').to('<ctrl>b', 5)
+    activator.bind('any', 'other', None, None).to('<ctrl>a')
+
+    ka = parse_key('<ctrl>a')
+    kb = parse_key('<ctrl>b')
+    kc = parse_key('<ctrl>c')
+    assert sorted(activator.get_km_for_action(('any',), 'action')) == [(ka, 0, False), (kb, -5, False)]
+
+    activator.replace_keys(('any',), 'action', [(kc, 1)])
+    assert activator.get_km_for_action(('any',), 'action') == [(kc, -1, False)]
+    assert activator.get_km_for_action(('any',), 'other') == [(ka, 0, False)]
+    assert activator.shortcuts[kb] == []
+
+def test_cached_context_invalidation():
+    activator = KeyMap().get_activator()
+    calls = []
+
+    def provider():
+        calls.append('provider')
+        return 'doc'
+
+    activator.add_context('doc', None, provider, invalidate_on='doc-changed')
+    activator.add_context('editor', 'doc', lambda doc: calls.append('editor') or doc,
+        invalidate_on='other')
+    activator.bind('editor', 'action', None, calls.append).to('<ctrl>a')
+
+    window = Window()
+    activate(activator, '<ctrl>a', window)
+    activate(activator, '<ctrl>a', window)
+    assert calls == ['provider', 'editor', 'doc', 'doc']
+
+    activator.invalidate_context('doc-changed')
+    activate(activator, '<ctrl>a', window)
+    assert calls[4:] == ['provider', 'editor', 'doc']
+    assert activator.context_cache_stats['editor'] == [1, 2]
+    assert activator.get_context_cache_stats() == (1, 4)
+
+def test_context_cycles_are_rejected():
+    activator = KeyMap().get_activator()
+    activator.add_context('a', 'b', lambda b: b)
+    activator.add_context('b', 'c', lambda c: c)
+
+    try:
+        activator.add_context('c', 'a', lambda a: a)
+    except ValueError:
+        pass
+    else:
+        assert False, 'Cycle is not detected'
+
+    assert 'c' not in activator.contexts
+
+    try:
+        activator.validate_contexts()
+    except KeyError as e:
+        assert '[c]' in str(e)
+    else:
+        assert False, 'Missing provider is not detected'
+
+def test_cheap_contexts_are_checked_first():
+    activator = KeyMap().get_activator()
+    calls = []
+
+    activator.add_context('expensive', None, lambda: calls.append('expensive'), cost=100)
+    activator.add_context('base', 'window', lambda w: calls.append('base') or w)
+    activator.add_context('cheap', 'base', lambda b: calls.append('cheap'))
+    activator.bind(('expensive', 'cheap'), 'action', None, calls.append).to('<ctrl>a')
+
+    activate(activator, '<ctrl>a')
+    assert calls == ['base', 'cheap']
+
+def test_batch_keeps_untouched_keys_connected():
+    activator = KeyMap().get_activator()
+    activator.bind('any', 'first', None, None).to('<ctrl>a')
+    activator.bind('any', 'second', None, None).to('<ctrl>b')
+
+    ka = parse_key('<ctrl>a')
+    kb = parse_key('<ctrl>b')
+    kc = parse_key('<ctrl>c')
+
+    with activator.batch():
+        activator.replace_keys(('any',), 'first', [(kb, 0)])
+        activator.replace_keys(('any',), 'second', [(ka, 0), (kc, 0)])
+        assert activator.connected_keys == set([ka, kb])
+
+    assert activator.connected_keys == set([ka, kb, kc])
+    assert [r[2] for r in activator.shortcuts[ka]] == ['second']
+    assert [r[2] for r in activator.shortcuts[kb]] == ['first']
+
+def test_keymap_cache_and_save(tmpdir, monkeypatch):
+    from uxie import keymap
+
+    config = tmpdir.join('keys.conf')
+    config.write("generic = {\n    'copy': [('<ctrl>c', 0)],\n}\n")
+    cache = str(tmpdir.join('keys.cache'))
+
+    km = KeyMap(str(config), cache)
+    assert km.generic_shortcuts['copy'] == [(parse_key('<ctrl>c'), 0)]
+    km.save_cache()
+
+    # Config must come from the cache
+    monkeypatch.setattr(keymap, 'load_keymap_config', None)
+    km = KeyMap(str(config), cache)
+    assert km.changed_generics == {'copy': [('<ctrl>c', 0)]}
+
+    km.replace_generics('copy', [(parse_key('<ctrl>x'), 0)])
+    km.save()
+    km.save()
+    km.flush()
+    assert tmpdir.listdir(lambda p: p.basename.startswith('.')) == []
+
+    monkeypatch.undo()
+    assert keymap.load_keymap_config(str(config))['generic'] == km.changed_generics
+
+def get_menu_tree(menu):
+    result = []
+    for _, name in menu.entries:
+        entry = menu.items[name]
+        if hasattr(entry, 'entries'):
+            result.append((entry.title, get_menu_tree(entry)))
+        else:
+            result.append((entry.title, entry.ctx, entry.name))
+
+    return result
+
+def test_bind_many_is_equal_to_bind():
+    rows = [
+        ('any', 'open', 'File/_Open#10', None, '<ctrl>o'),
+        ('any', 'save', 'File/_Save', None, ['<ctrl>s', ('F2', 5)]),
+        ('editor', 'copy', 'Edit#5/Copy', None),
+        ('any', 'new', 'File/New#1', None, None, (1, 2)),
+        ('any', 'quit', 'File/Quit', None),
+        ('any', 'about', 'About#1', None),
+    ]
+
+    activator = KeyMap().get_activator()
+    for row in rows:
+        binder = activator.bind(row[0], row[1], row[2], row[3], *(row[5] if len(row) > 5 else ()))
+        accels = row[4] if len(row) > 4 else None
+        if isinstance(accels, str):
+            accels = [accels]
+
+        for accel in accels or ():
+            binder.to(*(accel if isinstance(accel, tuple) else (accel,)))
+
+    bulk = KeyMap().get_activator()
+    bulk.bind_many(rows)
+
+    assert get_menu_tree(bulk.menu) == get_menu_tree(activator.menu)
+    assert bulk.shortcuts == activator.shortcuts
+    assert bulk.actions[('any',)]['new'].args == (1, 2)
+
+def test_activation_profiler(tmpdir):
+    from uxie.profiler import ActionProfiler
+
+    activator = KeyMap().get_activator()
+    activator.add_context('doc', None, lambda: 'doc')
+    activator.bind('doc', 'action', None, lambda doc: None).to('<ctrl>a')
+    activator.bind_dynamic('any', 'dyn', None, None, lambda p: (lambda: None, (), p))
+    activator.map('any', '!dyn/foo', '<ctrl>d')
+
+    activate(activator, '<ctrl>a')
+    profiler = ActionProfiler()
+    activator.set_profiler(profiler)
+    activate(activator, '<ctrl>a')
+    activate(activator, '<ctrl>a')
+    activate(activator, '<ctrl>d')
+
+    stats = profiler.get('doc:action')
+    assert sorted(stats) == ['callback', 'context:doc']
+    assert stats['callback'].count == 2
+    assert sorted(profiler.get('any:!dyn/foo')) == ['callback', 'resolve']
+
+    profiler.dump(str(tmpdir.join('profile.json')))
+    activator.set_profiler(None)
+    activate(activator, '<ctrl>a')
+    assert stats['callback'].count == 2
+
+class KeyEvent(object):
+    def __init__(self, accel):
+        self.keyval, self.state = parse_key(accel)
+
+def test_key_sequences():
+    activator = KeyMap().get_activator()
+    calls = []
+    feedback = []
+    activator.sequence_feedback = lambda window, prefix: feedback.append(prefix)
+
+    activator.bind('any', 'save', None, calls.append, 'save').to('<ctrl>x <ctrl>s')
+    activator.bind('any', 'other', None, calls.append, 'other').to('<ctrl>x <ctrl>o <ctrl>o')
+    activator.bind('any', 'single', None, calls.append, 'single').to('<ctrl>s')
+
+    ka = parse_key('<ctrl>x')
+    assert ka in activator.connected_keys
+
+    window = Window()
+    assert activate(activator, '<ctrl>x', window)
+    assert window.pending_sequence
+    assert activator.on_key_press(window, KeyEvent('<ctrl>s'))
+    assert not window.pending_sequence
+    assert calls == ['save']
+
+    activate(activator, '<ctrl>x', window)
+    activator.on_key_press(window, KeyEvent('<ctrl>o'))
+    activator.on_key_press(window, KeyEvent('<ctrl>o'))
+    activate(activator, '<ctrl>s', window)
+    assert calls == ['save', 'other', 'single']
+    assert len(feedback) == 6 and feedback[-1] is None
+
+    seq = activator.get_km_for_action(('any',), 'save')[0][0]
+    activator.replace_keys(('any',), 'save', [])
+    activator.replace_keys(('any',), 'other', [])
+    assert activator.sequence_prefixes == {}
+    assert ka not in activator.connected_keys
+
+    activator.replace_keys(('any',), 'other', [(seq, 0)])
+    (accel, _), = activator.changed_shortcuts[(('any',), 'other')]
+    assert parse_accel(accel)[0] == seq
+    assert ka in activator.connected_keys
+
+class FocusWindow(Window):
+    # Focused widget handles every key
+    def __init__(self):
+        self.focus_keys = []
+
+    def get_focus(self):
+        return self
+
+    def event(self, event):
+        self.focus_keys.append((event.keyval, event.state))
+        return True
+
+def test_sequence_priority_on_key_press():
+    activator = KeyMap().get_activator()
+    activator.bind('any', 'save', None, None).to('<ctrl>x <ctrl>s', 10)
+    activator.bind('any', 'open', None, None).to('<ctrl>x <ctrl>o')
+    activator.bind('any', 'mark', None, None).to('<ctrl>y <ctrl>m')
+
+    # First key of a prioritized sequence goes to accel group
+    window = FocusWindow()
+    assert not activator.on_key_press(window, KeyEvent('<ctrl>x'))
+    assert activator.on_key_press(window, KeyEvent('<ctrl>y'))
+    assert window.focus_keys == [parse_key('<ctrl>y')]
+
+    activator.replace_keys(('any',), 'save', [])
+    assert activator.on_key_press(window, KeyEvent('<ctrl>x'))
+    assert window.focus_keys[-1] == parse_key('<ctrl>x')
+
+def test_command_index_search():
+    activator = KeyMap().get_activator()
+    activator.add_context('missing', None, lambda: None)
+
+    activator.bind('any', 'open', 'File/_Open', None)
+    activator.bind('any', 'open-recent', 'File/Open _recent', None)
+    activator.bind('any', 'reopen', 'Edit/Reopen', None)
+    activator.bind('missing', 'open-missing', 'File/Open missing', None)
+    activator.bind_dynamic('any', 'buffers', 'Window/Buffers', lambda: [
+        ('main.py', 'main', (None, ())), ('utils.py', 'utils', (None, ())),
+        ('pyproject.toml', 'pyproject', (None, ()))], None)
+
+    index = activator.command_index
+    ctx_getter = activator.make_context_getter(Window())
+    find = lambda q, **kw: [e.name for e in index.search(q, ctx_getter, **kw)]
+
+    assert find('file/open') == ['open', 'open-recent']
+    # Titles starting with the first word go first
+    assert find('open') == ['open', 'open-recent', 'reopen']
+    assert find('rec op') == ['open-recent']
+    assert find('op', limit=1) == ['open']
+
+    dynamic = list(index.get_dynamic_items(ctx_getter))
+    assert find('util', extra=dynamic) == ['!buffers/utils']
+    assert find('py', extra=dynamic) == ['!buffers/pyproject', '!buffers/main', '!buffers/utils']
@@ -0,0 +1,297 @@
+from uxie import complete
+from uxie.complete import (Completer, FillWorker, CancelToken, CompletionStats,
+    merge_ranked, limit_provider)
+
+
+def test_fill_worker_streams_batches(monkeypatch):
+    calls = []
+    monkeypatch.setattr(complete.glib, 'idle_add', lambda func, *args: func(*args))
+
+    def fetch(token, query):
+        for i in range(5):
+            if i == 3:
+                token.cancel()
+            yield query, i
+
+    worker = FillWorker(batch_size=2, batch_delay=10)
+    worker.fetch(CancelToken(), lambda t, q: iter([(q, 1), (q, 2), (q, 3)]), 'a',
+        lambda token, rows: calls.append(rows), lambda token: calls.append('done'))
+    assert calls == [[('a', 1), ('a', 2)], [('a', 3)], 'done']
+
+    calls[:] = []
+    worker.fetch(CancelToken(), fetch, 'b',
+        lambda token, rows: calls.append(rows), lambda token: calls.append('done'))
+    assert calls == [[('b', 0), ('b', 1)]]
+
+    token = CancelToken()
+    token.cancel()
+    calls[:] = []
+    worker.fetch(token, fetch, 'c', calls.append, calls.append)
+    assert calls == []
+
+
+def test_refine_cache():
+    from uxie.complete import RefineCache
+
+    cache = RefineCache(lambda query, row: row.startswith(query), size=2)
+    assert cache.get('a') is None
+    cache.put('a', ['ab', 'abc', 'ac'])
+
+    assert cache.get('ab') == ['ab', 'abc']
+    assert cache.get('abc') == ['abc']
+    assert cache.get('ab') == ['ab', 'abc']
+    assert cache.get('a') is None
+
+    cache.put('b', ['ba', 'bb'], refinable=False)
+    assert cache.get('ba') is None
+
+    cache.invalidate()
+    assert cache.get('b') is None
+
+
+def test_merge_ranked_is_lazy():
+    consumed = []
+    def source(name, scores):
+        for s in scores:
+            consumed.append((name, s))
+            yield s, name + str(s)
+
+    rows = merge_ranked([source('a', [1, 4, 5, 6]), source('b', [2, 3, 9])], 3)
+    assert rows == ['a1', 'b2', 'b3']
+    assert ('a', 6) not in consumed and ('b', 9) not in consumed
+
+    assert merge_ranked([iter([(1, 'x')]), iter([(1, 'y')])]) == ['x', 'y']
+
+    fetch = limit_provider(lambda token, query: ((i, query) for i in range(10)), 2, 3)
+    assert list(fetch(None, 'q')) == [(0, 2, 'q'), (1, 2, 'q'), (2, 2, 'q')]
+
+
+class Model(list):
+    appended = 0
+
+    def append(self, row):
+        list.append(self, row)
+        self.appended += 1
+
+    def clear(self):
+        del self[:]
+
+
+class View(object):
+    def __init__(self):
+        self.model = Model()
+        self.cursor = None
+        self.selected = 0
+        self.window = self
+        self.blocked = 0
+
+    def get_model(self):
+        return self.model
+
+    def get_cursor(self):
+        return self.cursor, None
+
+    def set_cursor(self, path):
+        self.cursor = path
+        self.selected = 0 if self.blocked else 1
+
+    def get_selection(self):
+        return self
+
+    def count_selected_rows(self):
+        return self.selected
+
+    def unselect_all(self):
+        self.selected = 0
+
+    def freeze_updates(self):
+        pass
+
+    thaw_updates = freeze_updates
+
+    def handler_block(self, handler_id):
+        self.blocked += 1
+
+    def handler_unblock(self, handler_id):
+        self.blocked -= 1
+
+
+class Worker(object):
+    def __init__(self):
+        self.requests = []
+
+    def submit(self, token, fetch_cb, query, on_batch, on_done):
+        self.requests.append((token, list(fetch_cb(token, query)), on_batch, on_done))
+
+
+def completer_method(name):
+    return getattr(Completer, name).im_func
+
+
+class FakeCompleter(object):
+    # Completer request handling without gtk window
+    complete = completer_method('complete')
+    cancel_pending = completer_method('cancel_pending')
+    run_pending = completer_method('run_pending')
+    set_delay = completer_method('set_delay')
+    cancel_fetch = completer_method('cancel_fetch')
+    on_key_press_event = completer_method('on_key_press_event')
+    on_main_window_focus_out = completer_method('on_main_window_focus_out')
+    request_merge = completer_method('request_merge')
+    merge_rows = completer_method('merge_rows')
+    finish_merge = completer_method('finish_merge')
+    finish_fetch = completer_method('finish_fetch')
+    refill_model = completer_method('refill_model')
+    reset_cursor = completer_method('reset_cursor')
+    fill_model = completer_method('fill_model')
+    set_rows = completer_method('set_rows')
+    record_latency = completer_method('record_latency')
+
+    def __init__(self):
+        self.view = View()
+        self.active = False
+        self.fill_token = None
+        self.fill_started = False
+        self.fill_time = None
+        self.fill_delay = 0
+        self.stats = CompletionStats()
+        self.cursor_changed_handler_id = 1
+        self.provider_workers = [Worker(), Worker()]
+        self.fills = []
+
+    def popup(self, widget):
+        self.active = True
+
+    def popdown(self, widget):
+        self.cancel_fetch()
+        self.active = False
+
+    def is_stop(self, widget):
+        return None
+
+    def request_fill(self, widget, check, args):
+        self.fills.append(args)
+
+    def set_position(self, widget):
+        pass
+
+
+class Widget(object):
+    completer_limit = 4
+
+    def completer_query_cb(self, view, widget):
+        return 'q'
+
+
+def test_merge_providers_async():
+    fast = lambda token, query: ((s, ('a%d' % s,)) for s in (1, 3, 5, 7, 9))
+    slow = lambda token, query: ((s, ('b%d' % s,)) for s in (2, 4))
+    widget = Widget()
+    widget.completer_providers = [fast, slow]
+    completer = FakeCompleter()
+    view = completer.view
+
+    completer.request_merge(widget, ())
+    token, fast_rows, on_fast, fast_done = completer.provider_workers[0].requests[0]
+    _, slow_rows, on_slow, slow_done = completer.provider_workers[1].requests[0]
+    assert len(fast_rows) == 4
+
+    # First batch pops up, later worse rows are appended
+    on_fast(token, fast_rows[:2])
+    assert completer.active and view.model == [('a1',), ('a3',)]
+    view.model.appended = 0
+    on_fast(token, fast_rows[2:])
+    assert view.model.appended == 2
+    assert view.model == [('a1',), ('a3',), ('a5',), ('a7',)]
+    fast_done(token)
+    assert completer.fill_token is token
+
+    # Better rows refill the model, cursor stays on the selected row
+    view.set_cursor((1,))
+    on_slow(token, slow_rows)
+    assert view.model == [('a1',), ('b2',), ('a3',), ('b4',)]
+    assert view.cursor == (2,) and view.blocked == 0
+    slow_done(token)
+    assert completer.fill_token is None
+
+    # Stale results of a replaced request are ignored
+    completer.request_merge(widget, ())
+    on_fast(token, [(0, 0, ('stale',))])
+    slow_done(token)
+    assert view.model == [('a1',), ('b2',), ('a3',), ('b4',)]
+    assert completer.fill_token is not None
+
+
+class Timers(object):
+    def __init__(self):
+        self.sources = {}
+        self.last = 0
+
+    def timeout_add(self, delay, func, *args):
+        self.last += 1
+        self.sources[self.last] = delay, func, args
+        return self.last
+
+    def idle_add(self, func, *args):
+        return self.timeout_add(None, func, *args)
+
+    def source_remove(self, source):
+        del self.sources[source]
+
+    def fire(self):
+        _, func, args = self.sources.pop(self.last)
+        func(*args)
+
+
+class Keymap(object):
+    def translate_keyboard_state(self, keycode, state, group):
+        return keycode, 0, 0, 0
+
+
+class Event(object):
+    def __init__(self, keyval):
+        self.hardware_keycode = keyval
+        self.state = 0
+        self.group = 0
+
+
+def test_complete_coalesces_requests(monkeypatch):
+    timers = Timers()
+    monkeypatch.setattr(complete.glib, 'timeout_add', timers.timeout_add)
+    monkeypatch.setattr(complete.glib, 'idle_add', timers.idle_add)
+    monkeypatch.setattr(complete.glib, 'source_remove', timers.source_remove)
+    monkeypatch.setattr(complete.gtk.gdk, 'keymap_get_default', Keymap)
+
+    completer = FakeCompleter()
+    widget = Widget()
+
+    # Burst leaves one pending idle source with last args
+    for args in 'abc':
+        completer.complete(widget, args)
+
+    assert len(timers.sources) == 1
+    assert timers.sources.values()[0][0] is None
+    timers.fire()
+    assert completer.fills == [('c',)]
+    assert completer.stats.as_dict()['requests'] == 3
+    assert (completer.stats.discarded, completer.stats.fills) == (2, 1)
+    assert widget.completer_pending is None
+
+    # Newer fill cancels a running fetch
+    token = completer.fill_token = CancelToken()
+    completer.set_delay(widget, 100)
+    completer.complete(widget, 'd')
+    assert timers.sources.values()[0][0] == 100
+    timers.fire()
+    assert token.cancelled and completer.stats.cancelled == 1
+
+    # Escape and focus out drop pending request
+    completer.complete(widget, 'e')
+    assert completer.on_key_press_event(widget, Event(complete.gtk.keysyms.Escape))
+    assert timers.sources == {}
+
+    completer.complete(widget, 'f')
+    completer.on_main_window_focus_out(None, None, widget)
+    assert timers.sources == {}
+    assert completer.fills == [('c',), ('d',)]
+    assert (completer.stats.requests, completer.stats.discarded) == (6, 2)
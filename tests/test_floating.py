@@ -0,0 +1,72 @@
+from uxie import floating
+from uxie.floating import Manager
+
+
+class Parent(object):
+    pass
+
+
+class Float(object):
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def cancel(self):
+        self.active = False
+
+
+class Timers(object):
+    def __init__(self):
+        self.sources = {}
+        self.last = 0
+
+    def timeout_add(self, delay, func):
+        self.last += 1
+        self.sources[self.last] = delay, func
+        return self.last
+
+    def source_remove(self, source):
+        del self.sources[source]
+
+    def fire(self):
+        delay, func = self.sources.pop(self.last)
+        func()
+
+
+def test_single_timer_for_timeouts(monkeypatch):
+    now = [100.0]
+    timers = Timers()
+    arranged = []
+    monkeypatch.setattr(floating.time, 'time', lambda: now[0])
+    monkeypatch.setattr(floating.glib, 'timeout_add', timers.timeout_add)
+    monkeypatch.setattr(floating.glib, 'source_remove', timers.source_remove)
+    monkeypatch.setattr(Manager, 'arrange', lambda self, parent: arranged.append(parent))
+
+    fm = Manager()
+    parent = Parent()
+    floats = [Float() for _ in range(4)]
+    for f, timeout in zip(floats, (3000, 1000, 1020, 2000)):
+        fm.add(parent, f, timeout=timeout)
+
+    assert timers.sources.values() == [(1000, fm.expire)]
+
+    # Close deadlines expire together with one arrange
+    arranged[:] = []
+    now[0] += 1
+    timers.fire()
+    assert [f.active for f in floats] == [True, False, False, True]
+    assert arranged == [parent]
+    assert timers.sources.values() == [(1000, fm.expire)]
+
+    floats[3].cancel()
+    now[0] += 1
+    timers.fire()
+    assert arranged == [parent]
+    assert timers.sources.values() == [(1000, fm.expire)]
+
+    now[0] += 1
+    timers.fire()
+    assert not floats[0].active
+    assert timers.sources == {}
@@ -0,0 +1,55 @@
+from array import array
+
+from uxie import fuzzy
+from uxie.fuzzy import Matcher, highlight
+from uxie.cancel import CancelToken
+
+
+def test_match_ranking_and_positions():
+    matcher = Matcher(['get_buffer_window', 'buffer_window', 'bufwin', 'window', 'b_u_f'])
+    result = matcher.match('bufw')
+    assert [r[0] for r in result] == ['bufwin', 'buffer_window', 'get_buffer_window']
+    assert result[0][1] == [0, 1, 2, 3]
+    assert result[1][1] == [0, 1, 2, 7]
+
+    assert matcher.match('BUF', limit=1) == [('bufwin', [0, 1, 2])]
+    assert matcher.match('xyz') == []
+    assert len(matcher.match('')) == 5
+
+def test_match_key_and_fetch():
+    items = [('Open <File>', 1), ('Close', 2)]
+    matcher = Matcher(items, key=lambda r: r[0])
+    assert matcher.match('of') == [(items[0], [0, 6])]
+    assert list(matcher.fetch(CancelToken(), 'of')) == [
+        ('Open <File>', '<b>O</b>pen &lt;<b>F</b>ile&gt;')]
+
+    token = CancelToken()
+    token.cancel()
+    assert matcher.match('o', token=token) is None
+
+def test_match_uses_most_compact_occurrence():
+    matcher = Matcher(['a_long_b', 'axxxxxxab', 'ab_xaxb'])
+    assert matcher.match('ab') == [
+        ('ab_xaxb', [0, 1]), ('axxxxxxab', [7, 8]), ('a_long_b', [0, 7])]
+    assert matcher.match('xab') == [('axxxxxxab', [6, 7, 8]), ('ab_xaxb', [3, 4, 6])]
+
+def test_truncated_fetch_is_not_refinable():
+    matcher = Matcher(['ab%d' % i for i in range(5)])
+    token = CancelToken()
+    assert len(list(matcher.fetch(token, 'ab', limit=3))) == 3
+    assert not token.refinable
+
+    token = CancelToken()
+    assert len(list(matcher.fetch(token, 'ab', limit=5))) == 5
+    assert token.refinable
+
+def test_highlight():
+    assert highlight('a&b', [0, 2]) == '<b>a</b>&amp;<b>b</b>'
+
+def test_masks_fit_signed_long(monkeypatch):
+    masks = array('l', [fuzzy.get_mask(''.join(map(chr, range(256)))), fuzzy.get_mask(u'\u0436')])
+    assert masks[1] == fuzzy.UNKNOWN_CHAR_BIT
+
+    # 32 bit longs fold chars onto 31 bits
+    monkeypatch.setattr(fuzzy, 'MASK_BITS', 31)
+    assert max(fuzzy.get_char_bit(r) for r in range(63)) == 1 << 30
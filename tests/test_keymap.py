@@ -0,0 +1,57 @@
+from uxie import keymap
+from uxie.keymap import (KeyMap, ShortcutTable, parse_key, key_name, parse_accel, accel_name,
+    keyval_to_lower, CONTROL_MASK, SHIFT_MASK, MOD1_MASK, SUPER_MASK)
+
+
+def test_parse_key():
+    assert parse_key('<ctrl>a') == (ord('a'), CONTROL_MASK)
+    assert parse_key('<Control><Shift>A') == (ord('a'), CONTROL_MASK | SHIFT_MASK)
+    assert parse_key('<alt>Return') == (0xff0d, MOD1_MASK)
+    assert parse_key('<super>F12') == (0xffc9, SUPER_MASK)
+    assert parse_key('<ctrl>comma') == (ord(','), CONTROL_MASK)
+    assert parse_key('<foo>a') == (0, 0)
+    assert parse_key('<ctrl>') == (0, 0)
+    assert parse_key('NoSuchKey') == (0, 0)
+
+def test_accel_name_round_trip():
+    for accel in ('<ctrl>a', '<shift><alt>Page_Up', '<ctrl>x <ctrl>s', 'Escape', '<ctrl>slash'):
+        km, _ = parse_accel(accel)
+        assert parse_accel(accel_name(km))[0] == km
+
+    assert accel_name(parse_key('<ctrl><shift>z')) == '<Shift><Control>z'
+
+def test_unknown_keyvals_round_trip():
+    # Cyrillic_a and XF86AudioPlay are not in the headless table
+    for keyval in (0x6c1, 0x1008ff14):
+        name = key_name(keyval, CONTROL_MASK)
+        assert name == '<Control>0x%x' % keyval
+        assert parse_key(name) == (keyval, CONTROL_MASK)
+
+    assert keyval_to_lower(0x1000000 | 0x416) == 0x1000000 | 0x436
+
+def test_set_key_parser(monkeypatch):
+    monkeypatch.setattr(keymap.key_parser, 'parse', keymap.key_parser.parse)
+    monkeypatch.setattr(keymap.key_parser, 'name', keymap.key_parser.name)
+    keymap.set_key_parser(lambda accel: (42, CONTROL_MASK), lambda key, mod: 'answer')
+    try:
+        assert parse_accel('<ctrl>XF86AudioPlay')[0] == (42, CONTROL_MASK)
+        assert accel_name((42, CONTROL_MASK)) == 'answer'
+    finally:
+        keymap.accel_cache.clear()
+        keymap.accel_names.clear()
+
+def test_shortcut_table_is_gtk_free():
+    calls = []
+    table = ShortcutTable(KeyMap())
+    table.add_context('doc', None, lambda: 'doc')
+    table.actions[('doc',)] = {'save': lambda ctx_getter: calls.append('save')}
+    table.map('doc', 'save', '<ctrl>s')
+    table.map('doc', 'save', '<ctrl>x <ctrl>s')
+
+    km = parse_key('<ctrl>s')
+    ctx_getter = table.make_context_getter(None)
+    for action in table.find_actions(km, ctx_getter):
+        action(ctx_getter)
+
+    assert calls == ['save']
+    assert table.connected_keys == set([km, parse_key('<ctrl>x')])
@@ -0,0 +1,115 @@
+from uxie.actions import KeyMap
+from uxie.keymap import parse_key
+from uxie.plugins import Manager, LazyPlugin
+
+
+class Window(object):
+    last_shortcut = None
+
+
+def test_lazy_plugin_is_loaded_on_action_activation():
+    calls = []
+
+    def init(injector):
+        calls.append('init')
+        injector.bind('any', 'action', 'Plugin/Action', calls.append, 'action').to('<ctrl>a')
+        injector.on_ready('editor', calls.append)
+
+    activator = KeyMap().get_activator()
+    manager = Manager(activator)
+    manager.add_plugin(LazyPlugin(init, [('any', 'action', 'Plugin/Action', '<ctrl>a')]))
+    assert calls == []
+
+    key, mod = parse_key('<ctrl>a')
+    activator.activate(None, Window(), key, mod)
+    activator.activate(None, Window(), key, mod)
+    assert calls == ['init', 'action', 'action']
+    assert len(activator.shortcuts[(key, mod)]) == 1
+
+def test_lazy_plugin_is_loaded_on_ready():
+    calls = []
+
+    def init(injector):
+        calls.append('init')
+        injector.on_ready('editor', calls.append)
+
+    manager = Manager(KeyMap().get_activator())
+    manager.add_plugin(LazyPlugin(init, ready=['editor']))
+    editor1, editor2 = Window(), Window()
+    manager.ready('buffer', Window())
+    assert calls == []
+
+    manager.ready('editor', editor1)
+    manager.ready('editor', editor2)
+    assert calls == ['init', editor1, editor2]
+
+    # Plugin added after its ready name fired is loaded at once
+    calls[:] = []
+    manager.add_plugin(LazyPlugin(init, ready=['editor']))
+    assert calls[0] == 'init'
+    assert sorted(calls[1:]) == sorted([editor1, editor2])
+
+def test_startup_profiler(tmpdir):
+    from uxie.profiler import StartupProfiler
+
+    class Plugin(object):
+        name = 'plugin'
+
+        @staticmethod
+        def init(injector):
+            import json
+            injector.on_ready('editor', on_editor_ready)
+
+    def on_editor_ready(editor):
+        pass
+
+    manager = Manager(KeyMap().get_activator())
+    profiler = StartupProfiler()
+    manager.set_profiler(profiler)
+    manager.add_plugin(Plugin)
+    manager.ready('editor', Window())
+    manager.ready('editor', Window())
+
+    assert sorted(profiler.plugins['plugin']) == ['import', 'wall']
+    stats = profiler.callbacks['ready:editor']
+    name, = stats
+    assert name.endswith('.on_editor_ready')
+    assert stats[name].count == 2
+
+    report = str(tmpdir.join('report.txt'))
+    profiler.write_report(report)
+    assert 'on_editor_ready' in open(report).read()
+
+def test_event_subscriptions():
+    calls = []
+
+    class Listener(object):
+        def on_ready(self, obj):
+            calls.append(('weak', obj))
+
+    manager = Manager(KeyMap().get_activator())
+    e1, e2, e3 = Window(), Window(), Window()
+
+    sub = manager.on_ready('editor', lambda obj: calls.append(('low', obj)))
+    manager.on_ready('editor', lambda obj: calls.append(('high', obj)), priority=10)
+    manager.on_ready('editor', lambda objs: calls.append(('batch', objs)), batch=True)
+    listener = Listener()
+    manager.on_ready('editor', listener.on_ready, weak=True)
+
+    manager.ready('editor', e1)
+    assert calls == [('high', e1), ('low', e1), ('batch', [e1]), ('weak', e1)]
+
+    calls[:] = []
+    sub.cancel()
+    del listener
+    with manager.batch():
+        manager.ready('editor', e2)
+        manager.ready('editor', e3)
+        manager.done('editor', e3)
+
+    assert calls == [('high', e2), ('batch', [e2])]
+    assert len(manager.events.get(('ready', 'editor'))) == 2
+
+    calls[:] = []
+    manager.on_ready('editor', lambda objs: calls.append(len(objs)), batch=True)
+    assert calls == [2]
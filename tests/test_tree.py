@@ -57,4 +57,33 @@ def test_selection_list_store_delete_from_mid():
     del store[(1,)]
 
     assert not store.is_selected((0,))
-    assert not store.is_selected((1,))
\ No newline at end of file
+    assert not store.is_selected((1,))
+
+def test_virtual_list_model():
+    from uxie.tree import VirtualListModel
+
+    class View(object):
+        def set_model(self, model):
+            self.model = model
+
+    model = VirtualListModel(str)
+    view = View()
+    rows = [('one',), ('two',)]
+    model.replace(view, rows)
+    assert view.model is model
+    assert model.on_iter_n_children(None) == 2
+    assert model.on_get_value(model.on_iter_nth_child(None, 1), 0) == 'two'
+    assert model.on_iter_next(1) is None
+    assert model.on_get_iter((2,)) is None
+
+    model.append(('three',))
+    assert model.on_get_value(2, 0) == 'three'
+    model.clear()
+    assert model.on_iter_n_children(None) == 0
+    assert model.on_iter_children(None) is None
+    assert rows == [('one',), ('two',)]
+
+    # Rowrefs are the same objects kept by model
+    model.replace(view, [(str(i),) for i in range(1000)])
+    assert model.on_get_iter((700,)) is model.on_iter_nth_child(None, 700)
+    assert model.on_iter_next(model.on_get_iter((699,))) is model.refs[700]
@@ -1,5 +1,6 @@
+import os
 import sys
-from uxie.utils import lazy_func
+from uxie.utils import lazy_func, atomic_open
 from inspect import cleandoc
 
 def test_lazy_func(tmpdir):
@@ -34,4 +35,24 @@ def test_lazy_func(tmpdir):
     __import__('package.test')
     sys.path = old_path
 
-    sys.modules['package.test'].test()
\ No newline at end of file
+    sys.modules['package.test'].test()
+
+def test_atomic_open_keeps_mode(tmpdir):
+    config = tmpdir.join('config')
+    config.write('old')
+    config.chmod(0644)
+
+    with atomic_open(str(config)) as f:
+        f.write('new')
+
+    assert config.read() == 'new'
+    assert os.stat(str(config)).st_mode & 0777 == 0644
+
+    umask = os.umask(022)
+    try:
+        with atomic_open(str(tmpdir.join('new'))) as f:
+            f.write('data')
+    finally:
+        os.umask(umask)
+
+    assert os.stat(str(tmpdir.join('new'))).st_mode & 0777 == 0644
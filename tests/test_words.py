@@ -0,0 +1,121 @@
+import random
+
+from uxie.words import WordIndex
+
+def test_word_index_prefix_search():
+    index = WordIndex()
+    index.set_text('foo_bar foo_baz\nfoo_baz other\n\nfoo')
+
+    assert index.complete('foo') == [u'foo_baz', u'foo_bar']
+    assert index.complete('foo_bar') == []
+    assert index.complete('oth') == [u'other']
+    assert index.complete('xyz') == []
+
+def test_word_index_reindex():
+    index = WordIndex()
+    index.set_text('alpha beta\ngamma')
+
+    # Split first line
+    index.reindex(0, 1, ['alpha', 'beta delta'])
+    assert index.lines == [(u'alpha',), (u'beta', u'delta'), (u'gamma',)]
+    assert index.complete('del') == [u'delta']
+
+    # Join lines back and drop a word
+    index.reindex(0, 2, ['alpha beta'])
+    assert index.lines == [(u'alpha', u'beta'), (u'gamma',)]
+    assert index.complete('del') == []
+    assert index.words == [u'alpha', u'beta', u'gamma']
+    assert index.counts == {u'alpha': 1, u'beta': 1, u'gamma': 1}
+
+
+class Iter(object):
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.offset = offset
+
+    def copy(self):
+        return Iter(self.buf, self.offset)
+
+    def get_line(self):
+        return self.buf.text.count('\n', 0, self.offset)
+
+    def ends_line(self):
+        return self.buf.text[self.offset:self.offset + 1] in ('', '\n')
+
+    def forward_to_line_end(self):
+        end = self.buf.text.find('\n', self.offset)
+        self.offset = len(self.buf.text) if end < 0 else end
+
+
+class Buffer(object):
+    """TextBuffer emulation, lines are separated by \\n only"""
+    def __init__(self, text):
+        self.text = text
+        self.handlers = {}
+
+    def connect(self, signal, callback):
+        self.handlers.setdefault(signal, []).append(callback)
+        return signal, callback
+
+    def connect_after(self, signal, callback):
+        return self.connect(signal + '-after', callback)
+
+    def handler_disconnect(self, handler):
+        self.handlers[handler[0]].remove(handler[1])
+
+    def emit(self, signal, *args):
+        for callback in self.handlers.get(signal, []):
+            callback(self, *args)
+
+    def get_bounds(self):
+        return Iter(self, 0), Iter(self, len(self.text))
+
+    def get_text(self, start, end):
+        return self.text[start.offset:end.offset]
+
+    def get_line_count(self):
+        return self.text.count('\n') + 1
+
+    def get_iter_at_line(self, line):
+        offset = 0
+        for _ in range(line):
+            offset = self.text.index('\n', offset) + 1
+
+        return Iter(self, offset)
+
+    def insert(self, offset, text):
+        self.emit('insert-text', Iter(self, offset), text, len(text))
+        self.text = self.text[:offset] + text + self.text[offset:]
+        self.emit('insert-text-after', Iter(self, offset + len(text)), text, len(text))
+
+    def delete(self, start, end):
+        self.emit('delete-range', Iter(self, start), Iter(self, end))
+        self.text = self.text[:start] + self.text[end:]
+        self.emit('delete-range-after', Iter(self, start), Iter(self, start))
+
+
+def test_word_index_follows_buffer_changes():
+    rnd = random.Random(1)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'alphabet', 'be', 'gam']
+    make_text = lambda: ''.join(rnd.choice(words) + rnd.choice('  \n') for _ in range(rnd.randint(0, 6)))
+
+    buf = Buffer(make_text())
+    index = WordIndex()
+    index.attach(buf)
+    for _ in range(300):
+        size = len(buf.text)
+        if size and rnd.random() < 0.4:
+            start = rnd.randint(0, size)
+            buf.delete(start, min(size, start + rnd.randint(1, 20)))
+        else:
+            buf.insert(rnd.randint(0, size), make_text() or '\n')
+
+        full = WordIndex()
+        full.set_text(buf.text)
+        assert index.lines == full.lines
+        assert index.counts == full.counts
+        assert index.words == full.words
+
+    index.detach()
+    assert buf.handlers == {'insert-text': [], 'insert-text-after': [],
+        'delete-range': [], 'delete-range-after': []}
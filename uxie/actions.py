@@ -1,101 +1,85 @@
 # -*- coding: utf-8 -*-
+import atexit
+import weakref
+from time import time
 from bisect import bisect
+from heapq import merge
+from itertools import chain
+from operator import itemgetter
 import gtk
+import glib
 from gtk.keysyms import F2, Escape, Control_L, Control_R, Alt_L, Alt_R, Shift_L, Shift_R
-from gtk.gdk import SHIFT_MASK, CONTROL_MASK, MOD1_MASK, SUPER_MASK
 
-from .utils import make_missing_dirs
+from .utils import idle
+from .profiler import get_action_key
+from .keymap import (ANY_CTX, DEFAULT_PRIORITY, FOCUS_EVENT, DEFAULT_MOD_MASK,
+    MODIFIER_KEYS, SHIFT_MASK, CONTROL_MASK, MOD1_MASK, parse_key, key_name,
+    parse_accel, is_sequence, accel_name, normalize_context, ShortcutTable)
+from . import keymap
 
-ANY_CTX = ('any', )
-DEFAULT_PRIORITY = 0
+KEYMAP_SAVE_DELAY = 500
+SEQUENCE_TIMEOUT = 2000
+COMMAND_PALETTE_LIMIT = 100
 
-gtk.accelerator_set_default_mod_mask(SHIFT_MASK | CONTROL_MASK | MOD1_MASK | SUPER_MASK)
+default_mod_mask_is_set = False
 
-def parse_accel(accel, priority=None):
-    if priority is None:
-        priority = DEFAULT_PRIORITY
+def set_default_mod_mask():
+    global default_mod_mask_is_set
+    if not default_mod_mask_is_set:
+        gtk.accelerator_set_default_mod_mask(DEFAULT_MOD_MASK)
+        default_mod_mask_is_set = True
 
-    key, _modifier = km = gtk.accelerator_parse(accel)
-    if key == 0:
-        import warnings
-        warnings.warn("Can't parse %s" % accel)
+def gtk_parse_key(accel):
+    key, mod = gtk.accelerator_parse(accel)
+    if not key:
+        # Hex names of keyvals unknown to GTK, see gtk_key_name
+        return parse_key(accel)
 
-    return km, priority
-
-def normalize_context(ctx):
-    if isinstance(ctx, tuple):
-        return ctx
-    else:
-        return (ctx,)
+    return key, mod
 
+def gtk_key_name(keyval, mods):
+    if gtk.gdk.keyval_name(keyval):
+        return gtk.accelerator_name(keyval, mods)
 
-class KeyMap(object):
-    def __init__(self, config_filename=None):
-        self.generic_shortcuts = {}
-        self.config = {}
-        self.config_filename = config_filename
-
-        if config_filename:
-            self._load()
+    return key_name(keyval, mods)
 
-        self.changed_generics = self.config.setdefault('generic', {})
-        self.default_generics = {}
-        self._map_changed_generics()
+keymap.set_key_parser(gtk_parse_key, gtk_key_name)
 
-    def _load(self):
-        self.config.clear()
-        try:
-            execfile(self.config_filename, {}, self.config)
-        except IOError:
-            pass
-        except:
-            import traceback
-            traceback.print_exc()
+def get_accel_label(km):
+    if is_sequence(km):
+        return ' '.join(gtk.accelerator_get_label(*r) for r in km)
 
-    def _map_changed_generics(self):
-        for name, r in self.changed_generics.iteritems():
-            for accel, priority in r:
-                self._map_generic(name, accel, priority)
+    return gtk.accelerator_get_label(*km)
 
-    def _map_generic(self, name, accel, priority=None):
-        self.generic_shortcuts.setdefault(name, []).append(parse_accel(accel, priority))
 
-    def map_generic(self, name, accel, priority=None):
-        self.default_generics.setdefault(name, []).append(parse_accel(accel, priority))
-        if name not in self.changed_generics:
-            self._map_generic(name, accel, priority)
+class KeyMap(keymap.KeyMap):
+    def __init__(self, config_filename=None, cache_filename=None):
+        self.save_timer = None
+        keymap.KeyMap.__init__(self, config_filename, cache_filename)
+        if config_filename:
+            atexit.register(self.flush)
+            # Accelerators of default mappings are parsed by plugins during
+            # startup, cache them as soon as main loop starts
+            idle(self._update_cache)
 
     def get_activator(self, window=None, config_section=None):
-        config = self.config.setdefault(config_section, {}) if config_section else {}
-        return Activator(self, window, config)
-
-    def replace_generics(self, name, keys):
-        if name in self.default_generics and set(self.default_generics[name]) == set(keys):
-            self.changed_generics.pop(name, None)
-        else:
-            if keys or name in self.default_generics:
-                self.changed_generics[name] = [(gtk.accelerator_name(*km), pr) for km, pr in keys]
-            else:
-                self.changed_generics.pop(name, None)
-
-        self.generic_shortcuts.setdefault(name, [])[:] = []
-        for km, pr in keys:
-            self.generic_shortcuts[name].append((km, pr))
+        return Activator(self, window, self.get_config_section(config_section))
 
     def save(self):
-        if not self.config_filename:
-            return
+        # Several edits in a row cause one write, see flush
+        if self.config_filename and self.save_timer is None:
+            self.save_timer = glib.timeout_add(KEYMAP_SAVE_DELAY, self._save_timeout)
 
-        make_missing_dirs(self.config_filename)
-        with open(self.config_filename, 'w') as f:
-            for section, data in self.config.iteritems():
-                if section.startswith('_'):
-                    continue
+    def _save_timeout(self):
+        self.save_timer = None
+        self._save()
+        return False
 
-                print >> f, '%s = {' % section
-                for name, shortcuts in data.iteritems():
-                    print >> f, '    %s: %s,' % (repr(name), repr(shortcuts))
-                print >> f, '}\n'
+    def flush(self):
+        if self.save_timer is not None:
+            glib.source_remove(self.save_timer)
+            self.save_timer = None
+            self._save()
 
 
 class ContextHolder(object):
@@ -130,6 +114,15 @@ class AccelBinder(object):
         return self
 
 
+def set_accel_label(label, km):
+    full_accel_str = ', '.join(get_accel_label(r[0]) for r in km)
+    if len(km) > 1:
+        label.set_text(get_accel_label(km[0][0]) + '>')
+        label.set_tooltip_text(full_accel_str)
+    else:
+        label.set_text(full_accel_str)
+        label.set_tooltip_text(None)
+
 def create_entry_widget(cls, title, km):
     if km:
         item = cls(None, True)
@@ -139,13 +132,8 @@ def create_entry_widget(cls, title, km):
         label.set_use_underline(True)
         box.pack_start(label)
 
-        full_accel_str = ', '.join(gtk.accelerator_get_label(*r[0]) for r in km)
-        if len(km) > 1:
-            accel_label = gtk.Label(gtk.accelerator_get_label(*km[0][0]) + '>')
-            accel_label.set_tooltip_text(full_accel_str)
-        else:
-            accel_label = gtk.Label(full_accel_str)
-
+        accel_label = gtk.Label()
+        set_accel_label(accel_label, km)
         accel_label.set_alignment(1, 0.5)
         accel_label.modify_fg(gtk.STATE_NORMAL, accel_label.style.fg[gtk.STATE_INSENSITIVE])
         accel_label.modify_fg(gtk.STATE_PRELIGHT, accel_label.style.fg[gtk.STATE_INSENSITIVE])
@@ -153,9 +141,15 @@ def create_entry_widget(cls, title, km):
         item.add(box)
     else:
         item = cls(title, True)
+        accel_label = None
 
+    item.accel_label = accel_label
     return item
 
+def update_entry_widget(widget, km):
+    if km:
+        set_accel_label(widget.accel_label, km)
+
 
 class BaseEntry(object):
     def __init__(self, ctx, name):
@@ -166,6 +160,9 @@ class BaseEntry(object):
     def get_widget(self, _ctx_getterm, km):
         return create_entry_widget(gtk.MenuItem, self.title, km)
 
+    def update_widget(self, widget, _ctx_getter, km):
+        update_entry_widget(widget, km)
+
     def __repr__(self):
         return 'Entry(%s, %s, %s)' % (self.ctx, self.name, self.title)
 
@@ -192,9 +189,13 @@ class CheckEntry(Entry):
 
     def get_widget(self, ctx_getter, km):
         widget = create_entry_widget(gtk.CheckMenuItem, self.title, km)
+        self.update_widget(widget, ctx_getter, km)
+        return widget
+
+    def update_widget(self, widget, ctx_getter, km):
+        update_entry_widget(widget, km)
         ctx_obj = ctx_getter(self.ctx)
         widget.set_active(bool(self.callback(*(ctx_obj + (False,) + self.args))))
-        return widget
 
     def __call__(self, ctx_getter):
         ctx_obj = ctx_getter(self.ctx)
@@ -210,17 +211,134 @@ class DEntry(Entry):
         return self.callback(*self.args)
 
 
+class LazyEntry(BaseEntry):
+    # Stands in for an action of a lazy plugin. Loader imports and inits the
+    # plugin which binds the real entry under the same ctx and name.
+    def __init__(self, activator, ctx, name, loader):
+        BaseEntry.__init__(self, ctx, name)
+        self.activator = activator
+        self.loader = loader
+
+    def get_entry(self, load=True):
+        entry = self.activator.actions.get(self.ctx, {}).get(self.name)
+        if (entry is None or entry is self) and load:
+            self.loader()
+            entry = self.activator.actions.get(self.ctx, {}).get(self.name)
+
+        if entry is None or entry is self:
+            return None
+
+        entry.title = self.title
+        return entry
+
+    @property
+    def widget_type(self):
+        return type(self.get_entry(False))
+
+    def get_widget(self, ctx_getter, km):
+        entry = self.get_entry(False)
+        if entry:
+            return entry.get_widget(ctx_getter, km)
+
+        return BaseEntry.get_widget(self, ctx_getter, km)
+
+    def update_widget(self, widget, ctx_getter, km):
+        entry = self.get_entry(False)
+        if entry:
+            entry.update_widget(widget, ctx_getter, km)
+        else:
+            BaseEntry.update_widget(self, widget, ctx_getter, km)
+
+    def __call__(self, ctx_getter):
+        entry = self.get_entry()
+        if entry:
+            return entry(ctx_getter)
+
+        print 'Plugin did not bind [%s] action for %s context' % (self.name, self.ctx)
+
+
+class DynamicCache(object):
+    # Results are stored per first context object (weakly) and expire
+    # after ttl seconds if it is set
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.store = weakref.WeakKeyDictionary()
+        # ANY_CTX entries have no context objects
+        self.any_store = {}
+
+    def get_store(self, ctx_obj):
+        if not ctx_obj:
+            return self.any_store
+
+        try:
+            return self.store.setdefault(ctx_obj[0], {})
+        except TypeError:
+            raise TypeError("Can't cache dynamic entries of %r context object, "
+                "it is not weakly referenceable" % (ctx_obj[0],))
+
+    def get(self, ctx_obj, key):
+        try:
+            result, expire = self.get_store(ctx_obj)[ctx_obj[1:], key]
+        except KeyError:
+            raise KeyError(key)
+
+        if expire is not None and expire <= time():
+            raise KeyError(key)
+
+        return result
+
+    def set(self, ctx_obj, key, result):
+        expire = time() + self.ttl if self.ttl else None
+        self.get_store(ctx_obj)[ctx_obj[1:], key] = result, expire
+
+    def clear(self):
+        self.store.clear()
+        self.any_store.clear()
+
+
 class MultiEntry(BaseEntry):
-    def __init__(self, ctx, name, generator, resolver):
+    def __init__(self, ctx, name, generator, resolver, cache=None):
         BaseEntry.__init__(self, ctx, name)
         self.generator = generator
         self.resolver = resolver
+        self.cache = cache
 
     def get_entries(self, ctx_getter):
-        for title, eid, cb in self.generator(*ctx_getter(self.ctx)):
-            yield DEntry(self.ctx, self.name + '/' + eid, title, *cb)
+        ctx_obj = ctx_getter(self.ctx)
+        if self.cache:
+            try:
+                return self.cache.get(ctx_obj, None)
+            except KeyError:
+                pass
+
+        entries = list(self.generate(ctx_obj))
+        if self.cache:
+            self.cache.set(ctx_obj, None, entries)
+
+        return entries
 
     def resolve(self, ctx_obj, param):
+        if self.cache:
+            try:
+                return self.cache.get(ctx_obj, param)
+            except KeyError:
+                pass
+
+        result = self.resolve_entry(ctx_obj, param)
+        if self.cache:
+            self.cache.set(ctx_obj, param, result)
+
+        return result
+
+    def invalidate(self):
+        if self.cache:
+            self.cache.clear()
+
+    def generate(self, ctx_obj):
+        for title, eid, cb in self.generator(*ctx_obj):
+            yield DEntry(self.ctx, self.name + '/' + eid, title, *cb)
+
+    def resolve_entry(self, ctx_obj, param):
         result = self.resolver(*(ctx_obj + (param,)))
         if result:
             cb, args, title = result
@@ -234,15 +352,19 @@ class DRadioEntry(DEntry):
         widget.set_active(self.is_active)
         return widget
 
+    def update_widget(self, widget, _ctx_getter, km):
+        update_entry_widget(widget, km)
+        widget.set_active(self.is_active)
+
 
 class RadioEntry(MultiEntry):
-    def get_entries(self, ctx_getter):
-        for is_active, title, eid, cb in self.generator(*ctx_getter(self.ctx)):
+    def generate(self, ctx_obj):
+        for is_active, title, eid, cb in self.generator(*ctx_obj):
             entry = DRadioEntry(self.ctx, self.name + '/' + eid, title, *cb)
             entry.is_active = is_active
             yield entry
 
-    def resolve(self, ctx_obj, param):
+    def resolve_entry(self, ctx_obj, param):
         result = self.resolver(*(ctx_obj + (param,)))
         if result:
             is_active, cb, args, title = result
@@ -254,6 +376,7 @@ class RadioEntry(MultiEntry):
 class MenuEntry(object):
     def __init__(self):
         self.entries = []
+        self.indexes = []
         self.items = {}
         self.idx = 0
         self.path = ''
@@ -262,7 +385,10 @@ class MenuEntry(object):
     def get_widget(self, _ctx_getter, km):
         return create_entry_widget(gtk.MenuItem, self.title, km)
 
-    def get_entry(self, label, default=None, default_cb=None):
+    def update_widget(self, widget, _ctx_getter, km):
+        update_entry_widget(widget, km)
+
+    def get_entry(self, label, default=None, default_cb=None, append=False):
         label, _, idx = label.partition('#')
         entry = label.replace('_', '')
         try:
@@ -280,7 +406,13 @@ class MenuEntry(object):
                 idx = int(idx)
 
             self.idx = idx
-            self.entries.insert(bisect([i for i, _ in self.entries], idx), (idx, entry))
+            if append:
+                # Caller is responsible for sort_entries call
+                self.entries.append((idx, entry))
+            else:
+                pos = bisect(self.indexes, idx)
+                self.indexes.insert(pos, idx)
+                self.entries.insert(pos, (idx, entry))
 
             default.path = (self.path + '/' + entry) if self.path else entry
             default.title = label
@@ -291,6 +423,10 @@ class MenuEntry(object):
         else:
             raise KeyError(label)
 
+    def sort_entries(self):
+        self.entries.sort(key=itemgetter(0))
+        self.indexes[:] = [i for i, _ in self.entries]
+
     def get_entry_for_path(self, path):
         if not path:
             return self
@@ -318,24 +454,149 @@ class MenuEntry(object):
         return 'MenuEntry(%s)' % self.path
 
 
-class Activator(object):
+def get_ngrams(text, size=3):
+    for n in range(1, size + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i+n]
+
+
+class CommandIndex(object):
+    # Uni-, bi- and trigram index over menu entry paths. Query words are
+    # looked up by their trigrams (or themselves if shorter) and matched
+    # candidates are verified by substring check. Results are ranked by
+    # (title doesn't start with the first word, text length) and produced
+    # lazily, so broad queries stop as soon as the limit is reached.
+    def __init__(self):
+        self.items = []
+        self.titles = []
+        self.paths = set()
+        self.ngrams = {}
+        self.prefixes = {}
+        # Item ids sorted by text length, None until needed
+        self.by_length = None
+        self.dynamic = []
+
+    def add(self, entry):
+        if entry.path in self.paths:
+            return
+
+        self.paths.add(entry.path)
+        if isinstance(entry, MultiEntry):
+            self.dynamic.append(entry)
+            return
+
+        text = get_command_text(entry.path, entry.name)
+        title = get_title_text(entry)
+        idx = len(self.items)
+        self.items.append((text, entry))
+        self.titles.append(title)
+        for g in set(get_ngrams(text)):
+            self.ngrams.setdefault(g, set()).add(idx)
+
+        for n in range(1, 4):
+            self.prefixes.setdefault(title[:n], set()).add(idx)
+
+        self.by_length = None
+
+    def get_candidates(self, words):
+        postings = []
+        for w in words:
+            if len(w) <= 3:
+                postings.append(self.ngrams.get(w, ()))
+            else:
+                postings.extend(self.ngrams.get(w[i:i+3], ()) for i in range(len(w) - 2))
+
+        postings.sort(key=len)
+        if len(postings) == 1:
+            return postings[0]
+
+        result = set(postings[0])
+        for p in postings[1:]:
+            if not result:
+                break
+            result.intersection_update(p)
+
+        return result
+
+    def iter_ranked(self, words):
+        items = self.items
+        first = words[0]
+        candidates = self.get_candidates(words)
+        is_match = lambda i: all(w in items[i][0] for w in words)
+
+        starts = self.prefixes.get(first[:3], set()).intersection(candidates)
+        if len(first) > 3:
+            titles = self.titles
+            starts = set(i for i in starts if titles[i].startswith(first))
+
+        for i in self.iter_by_length(starts):
+            if is_match(i):
+                yield (0, len(items[i][0])), items[i]
+
+        for i in self.iter_by_length(candidates, starts):
+            if is_match(i):
+                yield (1, len(items[i][0])), items[i]
+
+    def iter_by_length(self, ids, exclude=()):
+        items = self.items
+        if len(ids) < 1000:
+            return sorted((i for i in ids if i not in exclude), key=lambda i: len(items[i][0]))
+
+        if self.by_length is None:
+            self.by_length = sorted(range(len(items)), key=lambda i: len(items[i][0]))
+
+        return (i for i in self.by_length if i in ids and i not in exclude)
+
+    def get_dynamic_items(self, ctx_getter):
+        for dentry in self.dynamic:
+            if dentry.is_match(ctx_getter):
+                path = dentry.path.rpartition('/')[0]
+                for entry in dentry.get_entries(ctx_getter):
+                    title = entry.title.replace('_', '')
+                    yield get_command_text(path + '/' + title if path else title, entry.name), entry
+
+    def search(self, query, ctx_getter, limit=COMMAND_PALETTE_LIMIT, extra=()):
+        words = query.lower().split()
+        if words:
+            first = words[0]
+            extra = sorted(((not get_title_text(r[1]).startswith(first), len(r[0])), r)
+                for r in extra if all(w in r[0] for w in words))
+            items = (r[1] for r in merge(self.iter_ranked(words), extra))
+        else:
+            items = chain(self.items, extra)
+
+        result = []
+        for text, entry in items:
+            if entry.is_match(ctx_getter):
+                result.append(entry)
+                if len(result) >= limit:
+                    break
+
+        return result
+
+
+def get_command_text(path, name):
+    return (path + ' ' + (name or '')).lower()
+
+def get_title_text(entry):
+    return entry.title.replace('_', '').lower()
+
+
+class Activator(ShortcutTable):
     def __init__(self, keymap, window=None, changed_shortcuts=None):
+        set_default_mod_mask()
         self.accel_group = gtk.AccelGroup()
-        self.actions = {}
-        self.shortcuts = {}
-        self.contexts = {}
+        self.sequence_timeout = SEQUENCE_TIMEOUT
+        self.sequence_feedback = None
         self.menu = MenuEntry()
+        self.menus = {}
+        self.command_index = CommandIndex()
         self.dyn_menu = {}
-
-        self.keymap = keymap
-        self.generic_shortcuts = keymap.generic_shortcuts
-
-        self.default_shortcuts = {}
-        self.changed_shortcuts = changed_shortcuts
-        self._map_changed_shortcuts()
+        ShortcutTable.__init__(self, keymap, changed_shortcuts)
 
         self.bind(('window', 'activator'), 'root-menu', None, show_actions_menu(''))
         self.bind_dynamic(('window', 'activator'), 'show-menu', None, None, actions_menu_resolver)
+        self.bind(('window', 'activator'), 'command-palette', None, show_command_palette)
 
         if window:
             self.attach(window)
@@ -343,8 +604,17 @@ class Activator(object):
     def attach(self, window):
         window.add_accel_group(self.accel_group)
         window.connect('key-press-event', self.on_key_press)
+        window.connect('set-focus', self.on_focus_change)
+
+    def on_focus_change(self, window, widget):
+        self.invalidate_context(FOCUS_EVENT, window)
 
     def on_key_press(self, window, event):
+        if getattr(window, 'pending_sequence', None):
+            return self._step_sequence(window, event)
+
+        # Shortcuts with positive priority go to accel group before focused
+        # widget, first keys of sequences too
         key = event.keyval, event.state & ~8192
         try:
             if key in self.shortcuts and self.shortcuts[key][0][0] < 0:
@@ -352,6 +622,9 @@ class Activator(object):
         except IndexError:
             pass
 
+        if (key,) in self.sequence_prefixes and self.get_prefix_priority((key,)) > 0:
+            return False
+
         w = window.get_focus()
         if w:
             if w.event(event):
@@ -362,18 +635,11 @@ class Activator(object):
     def on(self, *context):
         return ContextHolder(self, context)
 
-    def _map_changed_shortcuts(self):
-        if self.changed_shortcuts:
-            for (ctx, name), r in self.changed_shortcuts.iteritems():
-                for accel, priority in r:
-                    self._map(ctx, name, accel, priority)
-
-    def _add_shortcut(self, km, ctx, name, priority, is_generic=False):
-        shortcuts = self.shortcuts.setdefault(km, [])
-        if not shortcuts:
-            self.accel_group.connect_group(km[0], km[1], gtk.ACCEL_VISIBLE, self.activate)
+    def connect_key(self, km):
+        self.accel_group.connect_group(km[0], km[1], gtk.ACCEL_VISIBLE, self.activate)
 
-        shortcuts.insert(bisect(shortcuts, priority), (priority, ctx, name, is_generic))
+    def disconnect_key(self, km):
+        self.accel_group.disconnect_key(*km)
 
     def add_menu_entry(self, menu_entry, entry=None):
         new_submenu = lambda: MenuEntry()
@@ -385,22 +651,86 @@ class Activator(object):
         if items[-1]:
             assert entry
             menu = menu.get_entry(items[-1], entry)
+            self.command_index.add(menu)
 
         return menu
 
     def bind(self, ctx, name, menu_entry, callback, *args):
         ctx = normalize_context(ctx)
         entry = self.actions.setdefault(ctx, {})[name] = Entry(ctx, name, callback, args)
+        self._invalidate_action(ctx, name)
 
         if menu_entry:
             self.add_menu_entry(menu_entry, entry)
 
-        if name in self.generic_shortcuts:
-            for km, priority in self.generic_shortcuts[name]:
-                self._add_shortcut(km, ctx, name, -priority, True)
+        self._add_generic_shortcuts(ctx, name)
 
         return AccelBinder(self, ctx, name)
 
+    def bind_stub(self, ctx, name, menu_entry, loader):
+        # Placeholder for an action of not yet loaded plugin, see LazyEntry
+        ctx = normalize_context(ctx)
+        entry = self.actions.setdefault(ctx, {})[name] = LazyEntry(self, ctx, name, loader)
+        self._invalidate_action(ctx, name)
+
+        if menu_entry:
+            self.add_menu_entry(menu_entry, entry)
+
+        self._add_generic_shortcuts(ctx, name)
+        return AccelBinder(self, ctx, name)
+
+    def bind_many(self, actions):
+        # Registers rows of (ctx, name, menu_entry, callback[, accels[, args]])
+        # in one pass. Accels is an accel string or a list of accel strings
+        # and (accel, priority) tuples.
+        new_submenu = lambda: MenuEntry()
+        menus = {'': self.menu}
+        touched = set()
+
+        def get_menu(path):
+            try:
+                return menus[path]
+            except KeyError:
+                pass
+
+            parent_path, _, label = path.rpartition('/')
+            parent = get_menu(parent_path)
+            touched.add(parent)
+            menu = menus[path] = parent.get_entry(label, default_cb=new_submenu, append=True)
+            return menu
+
+        with self.batch():
+            for row in actions:
+                ctx, name, menu_entry, callback = row[:4]
+                accels = row[4] if len(row) > 4 else None
+                args = tuple(row[5]) if len(row) > 5 else ()
+
+                ctx = normalize_context(ctx)
+                entry = self.actions.setdefault(ctx, {})[name] = Entry(ctx, name, callback, args)
+
+                if menu_entry:
+                    path, _, label = menu_entry.rpartition('/')
+                    menu = get_menu(path)
+                    touched.add(menu)
+                    self.command_index.add(menu.get_entry(label, entry, append=True))
+
+                self._add_generic_shortcuts(ctx, name)
+
+                if accels:
+                    if isinstance(accels, str):
+                        accels = (accels,)
+
+                    for accel in accels:
+                        if isinstance(accel, tuple):
+                            self.map(ctx, name, *accel)
+                        else:
+                            self.map(ctx, name, accel)
+
+        for menu in touched:
+            menu.sort_entries()
+
+        self.dispatch.clear()
+
     def alias(self, ctx, name, menu_entry):
         ctx = normalize_context(ctx)
         self.add_menu_entry(menu_entry, self.actions[ctx][name])
@@ -408,13 +738,12 @@ class Activator(object):
     def bind_check(self, ctx, name, menu_entry, callback, *args):
         ctx = normalize_context(ctx)
         entry = self.actions.setdefault(ctx, {})[name] = CheckEntry(ctx, name, callback, args)
+        self._invalidate_action(ctx, name)
 
         if menu_entry:
             self.add_menu_entry(menu_entry, entry)
 
-        if name in self.generic_shortcuts:
-            for km, priority in self.generic_shortcuts[name]:
-                self._add_shortcut(km, ctx, name, -priority, True)
+        self._add_generic_shortcuts(ctx, name)
 
         return AccelBinder(self, ctx, name)
 
@@ -422,184 +751,210 @@ class Activator(object):
         entry = self.add_menu_entry(menu_entry+'/')
         return AccelBinder(self, entry.ctx, entry.name)
 
-    def bind_dynamic(self, ctx, name, menu_entry, generator, resolver, as_radio=False):
+    def bind_dynamic(self, ctx, name, menu_entry, generator, resolver, as_radio=False,
+            cache=False, ttl=None, invalidate_on=None):
+        # cache=True memoizes generated entries and resolved actions per
+        # context object until invalidated with invalidate_context for one of
+        # invalidate_on events. ttl or invalidate_on imply caching.
         ctx = normalize_context(ctx)
         name = '!' + name
         cls = RadioEntry if as_radio else MultiEntry
-        entry = self.actions.setdefault(ctx, {})[name] = cls(ctx, name, generator, resolver)
+
+        if isinstance(invalidate_on, str):
+            invalidate_on = (invalidate_on,)
+
+        for keys in self.dynamic_events.itervalues():
+            keys.discard((ctx, name))
+
+        dcache = None
+        if cache or ttl or invalidate_on:
+            dcache = DynamicCache(ttl)
+            for event in invalidate_on or ():
+                self.dynamic_events.setdefault(event, set()).add((ctx, name))
+
+        entry = self.actions.setdefault(ctx, {})[name] = cls(ctx, name, generator, resolver, dcache)
+        self._invalidate_action(ctx, name)
         if menu_entry:
             self.add_menu_entry(menu_entry, entry)
 
-    def _map(self, ctx, name, accel, priority=None):
-        km, priority = parse_accel(accel, priority)
-        self._add_shortcut(km, ctx, name, -priority, False)
+    def activate(self, _group, window, key, modifier):
+        km = key, modifier
+        if (km,) in self.sequence_prefixes and self._start_sequence(window, (km,)):
+            return True
 
-    def map(self, ctx, name, accel, priority=None):
-        assert ctx is not None
-        ctx = normalize_context(ctx)
-        key = ctx, name
-        self.default_shortcuts.setdefault(key, []).append(parse_accel(accel, priority))
-        if key not in self.changed_shortcuts:
-            self._map(ctx, name, accel, priority)
-
-    def replace_keys(self, ctx, name, keys):
-        key = ctx, name
-        if key in self.default_shortcuts and set(self.default_shortcuts[key]) == set(keys):
-            self.changed_shortcuts.pop(key, None)
-        else:
-            if keys or key in self.default_shortcuts:
-                self.changed_shortcuts[key] = [(gtk.accelerator_name(*km), pr) for km, pr in keys]
-            else:
-                self.changed_shortcuts.pop(key, None)
+        return self._dispatch(window, km)
 
-        for km in self.shortcuts:
-            actions = self.shortcuts[km]
-            actions[:] = [r for r in actions if r[1] != ctx or r[2] != name]
+    def _start_sequence(self, window, prefix, ctx_getter=None):
+        ctx_getter = ctx_getter or self.make_context_getter(window)
+        if all(ctx_getter(ctx) is None for ctx in self.sequence_prefixes[prefix]):
+            return False
 
-            if not actions:
-                self.accel_group.disconnect_key(*km)
+        timer = glib.timeout_add(self.sequence_timeout, self._sequence_timeout, window)
+        window.pending_sequence = prefix, timer, ctx_getter
+        if self.sequence_feedback:
+            self.sequence_feedback(window, prefix)
 
-        for km, pr in self.generic_shortcuts.get(name, []):
-            self._add_shortcut(km, ctx, name, -pr, True)
+        return True
 
-        for km, pr in keys:
-            self._add_shortcut(km, ctx, name, -pr, False)
+    def _sequence_timeout(self, window):
+        window.pending_sequence = None
+        if self.sequence_feedback:
+            self.sequence_feedback(window, None)
 
-    def activate(self, _group, window, key, modifier):
-        found_priority = 10000
-        actions = []
-        ctx_getter = self.make_context_getter(window)
+        return False
 
-        window.last_shortcut = key, modifier
-        for pr, ctx, name, _ in self.shortcuts[(key, modifier)]:
-            if pr > found_priority:
-                break
+    def cancel_sequence(self, window):
+        pending = getattr(window, 'pending_sequence', None)
+        if pending:
+            glib.source_remove(pending[1])
+            self._sequence_timeout(window)
+
+    def _step_sequence(self, window, event):
+        if event.keyval in MODIFIER_KEYS:
+            return False
+
+        prefix, _, ctx_getter = window.pending_sequence
+        self.cancel_sequence(window)
+        if event.keyval == Escape:
+            return True
+
+        km = gtk.gdk.keyval_to_lower(event.keyval), event.state & DEFAULT_MOD_MASK
+        seq = prefix + (km,)
+        if seq in self.sequence_prefixes and self._start_sequence(window, seq, ctx_getter):
+            return True
 
-            ctx_obj = ctx_getter(ctx)
-            if ctx_obj is not None:
-                try:
-                    action = self.actions[ctx][name]
-                except KeyError:
-                    if name[0] == '!':
-                        dname, _, param = name.partition('/')
-                        dmenu = self.actions[ctx][dname]
-                        action = dmenu.resolve(ctx_obj, param)
-                        if not action:
-                            continue
-                    else:
-                        raise KeyError('%s %s' % (ctx, name))
-
-                actions.append(action)
-                if pr < found_priority:
-                    found_priority = pr
+        if seq in self.shortcuts:
+            self._dispatch(window, seq, ctx_getter)
+
+        # Unknown sequences are swallowed too
+        return True
+
+    def _dispatch(self, window, km, ctx_getter=None):
+        profiler = self.profiler
+        if profiler:
+            profiler.start()
+
+        ctx_getter = ctx_getter or self.make_context_getter(window)
+        window.last_shortcut = km[-1] if is_sequence(km) else km
+        actions = self.find_actions(km, ctx_getter)
 
         if actions:
             if len(actions) == 1:
-                result = action(ctx_getter)
+                result = self._run_action(actions[0], ctx_getter)
                 return result is None or result
             else:
-                show_dups_menu(window, self, ctx_getter, actions)
+                if profiler:
+                    profiler.finish(None)
 
-        return False
-
-    def activate_menu_item(self, item):
-        item.get_parent().tr_window.last_shortcut = None, None
-        item.entry(item.ctx_getter)
-
-    def on_menu_key_press(self, menu, event):
-        if event.keyval == F2:
-            item = getattr(menu, 'current_item', None)
-            if item:
-                w = ShortcutChangeDialog(self, item.entry.ctx, item.entry.name)
-                w.set_transient_for(menu.tr_window)
-                menu.cancel()
-                w.show_all()
+                show_dups_menu(window, self, ctx_getter, actions)
 
-                return True
+        elif profiler:
+            profiler.finish(None)
 
         return False
 
-    def _find_context(self, ctx, cache):
-        if ctx == ANY_CTX:
-            return ()
+    def _run_action(self, action, ctx_getter):
+        profiler = self.profiler
+        if not profiler:
+            return action(ctx_getter)
 
-        if isinstance(ctx, tuple):
-            result = tuple(self._find_context(r, cache) for r in ctx)
-            return None if any(r is None for r in result) else result
+        t = time()
+        try:
+            return action(ctx_getter)
+        finally:
+            profiler.add('callback', time() - t)
+            profiler.finish(get_action_key(action))
+
+    def set_profiler(self, profiler):
+        # Pass None to turn instrumentation off
+        self.profiler = profiler
+        self.context_plans.clear()
 
+    def get_menu(self, key):
         try:
-            return cache[ctx]
+            return self.menus[key]
         except KeyError:
             pass
 
-        try:
-            depends, callback = self.contexts[ctx]
-        except KeyError:
-            print 'There are no any registered providers for [%s] context' % ctx
-            return None
+        menu = self.menus[key] = gtk.Menu()
+        return menu
 
-        if depends:
-            args = []
-            for dctx in depends:
-                d = self._find_context(dctx, cache)
-                if d is None:
-                    result = None
-                    break
+    def clear_menus(self):
+        for menu in self.menus.itervalues():
+            menu.destroy()
 
-                args.append(d)
-            else:
-                result = callback(*args)
-        else:
-            result = callback()
+        self.menus.clear()
 
-        cache[ctx] = result
-        return result
+    def activate_menu_item(self, item):
+        item.get_parent().tr_window.last_shortcut = None, None
+        if self.profiler:
+            self.profiler.start()
 
-    def make_context_getter(self, window):
-        cache = {'window':window, 'activator':self}
-        def ctx_getter(ctx):
-            return self._find_context(ctx, cache)
+        self._run_action(item.entry, item.ctx_getter)
 
-        cache['ctx_getter'] = ctx_getter
+    def run_command(self, window, entry, ctx_getter):
+        window.last_shortcut = None, None
+        if self.profiler:
+            self.profiler.start()
 
-        return ctx_getter
+        self._run_action(entry, ctx_getter)
 
-    def get_km_for_action(self, ctx, name):
-        result = []
-        for km, actions in self.shortcuts.iteritems():
-            for pr, actx, aname, is_generic in actions:
-                if ctx == actx and name == aname:
-                    result.append((km, pr, is_generic))
+    def on_menu_key_press(self, menu, event):
+        if event.keyval == F2:
+            item = getattr(menu, 'current_item', None)
+            if item:
+                w = ShortcutChangeDialog(self, item.entry.ctx, item.entry.name)
+                w.set_transient_for(menu.tr_window)
+                menu.cancel()
+                w.show_all()
 
-        return result
+                return True
 
-    def add_context(self, ctx, depends, callback):
-        if isinstance(depends, str):
-            depends = (depends,)
-        self.contexts[ctx] = depends, callback
+        return False
 
 
 def on_item_select(item, is_select):
     item.get_parent().current_item = item if is_select else None
 
+def get_menu_fingerprint(actions, kms):
+    return tuple((e.ctx, e.name, e.title, bool(km), getattr(e, 'widget_type', None))
+        for e, km in zip(actions, kms))
+
 def fill_menu(menu, window, activator, ctx_getter, actions):
-    menu.set_reserve_toggle_size(False)
+    # Menus are reused between popups. Items are rebuilt only if entry set
+    # changes, otherwise only their state and accelerator labels are updated.
+    actions = list(actions)
+    kms = [activator.get_km_for_action(e.ctx, e.name) for e in actions]
+    fingerprint = get_menu_fingerprint(actions, kms)
+
     menu.tr_window = window
+    menu.ctx_getter = ctx_getter
 
-    def activate_sub_menu(item, entry):
-        menu = item.get_submenu()
-        if not getattr(menu, 'already_filled', None):
-            fill_menu(menu, window, activator, ctx_getter, entry.get_entries(ctx_getter))
-            menu.already_filled = True
+    if getattr(menu, 'fingerprint', None) == fingerprint:
+        for item, entry, km in zip(menu.get_children(), actions, kms):
+            item.entry = entry
+            item.ctx_getter = ctx_getter
+            item.handler_block(item.activate_handler_id)
+            entry.update_widget(item, ctx_getter, km)
+            item.handler_unblock(item.activate_handler_id)
 
-    for entry in actions:
-        km = activator.get_km_for_action(entry.ctx, entry.name)
+        return
+
+    if hasattr(menu, 'fingerprint'):
+        for item in menu.get_children():
+            item.destroy()
+    else:
+        menu.set_reserve_toggle_size(False)
+        menu.connect('key-press-event', activator.on_menu_key_press)
+
+    menu.fingerprint = fingerprint
+    for entry, km in zip(actions, kms):
         item = entry.get_widget(ctx_getter, km)
         if isinstance(entry, MenuEntry):
             item.set_submenu(gtk.Menu())
-            item.connect('activate', activate_sub_menu, entry)
+            item.activate_handler_id = item.connect('activate', activate_sub_menu, activator)
         else:
-            item.connect('activate', activator.activate_menu_item)
+            item.activate_handler_id = item.connect('activate', activator.activate_menu_item)
 
         #item.contains_all_run_data = ard
 
@@ -610,9 +965,15 @@ def fill_menu(menu, window, activator, ctx_getter, actions):
         item.ctx_getter = ctx_getter
         menu.append(item)
 
-    menu.connect('key-press-event', activator.on_menu_key_press)
     menu.show_all()
 
+def activate_sub_menu(item, activator):
+    menu = item.get_submenu()
+    ctx_getter = item.ctx_getter
+    if getattr(menu, 'ctx_getter', None) is not ctx_getter:
+        fill_menu(menu, item.get_parent().tr_window, activator, ctx_getter,
+            item.entry.get_entries(ctx_getter))
+
 
 def actions_menu_resolver(window, activator, path=''):
     return show_actions_menu(path), (window, activator), path
@@ -633,7 +994,7 @@ def show_actions_menu(path=''):
         ctx_getter = activator.make_context_getter(window)
         actions = activator.menu.get_entry_for_path(path).get_entries(ctx_getter)
 
-        menu = gtk.Menu()
+        menu = activator.get_menu(path)
         fill_menu(menu, window, activator, ctx_getter, actions)
         popup_menu(menu, window)
 
@@ -647,10 +1008,14 @@ def show_dups_menu(window, activator, ctx_getter, actions):
 
         menu_actions.append(entry)
 
-    menu = gtk.Menu()
+    menu = activator.get_menu('!dups')
     fill_menu(menu, window, activator, ctx_getter, menu_actions)
     popup_menu(menu, window)
 
+def show_command_palette(window, activator):
+    palette = CommandPalette(activator, window)
+    palette.show_all()
+
 def wait_mod_unpress_for_last_shortcut(window, callback):
     key, mod = window.last_shortcut
     hid = getattr(window, 'mod_unpress_handler_id', None)
@@ -731,18 +1096,36 @@ class ShortcutChangeDialog(gtk.Window):
 
     def add_rows_if_needed(self, model):
         for r in list(model):
-            if r[0] == r[1] == 0:
+            if r[0] == r[1] == 0 and not r[3]:
                 del model[r.path]
 
-        model.append((0, 0, 0))
+        model.append((0, 0, 0, ''))
 
     def on_accel_edited(self, _renderer, path, key, mod, _code, model):
         model[path][0] = key
         model[path][1] = mod
+        model[path][3] = ''
+        self.add_rows_if_needed(model)
+
+    def on_sequence_edited(self, _renderer, path, text, model):
+        text = ' '.join(text.split())
+        if text:
+            km, _ = parse_accel(text)
+            if not is_sequence(km):
+                model[path][0], model[path][1] = km
+                text = ''
+            elif any(r[0] == 0 for r in km):
+                return
+            else:
+                model[path][0] = model[path][1] = 0
+
+        model[path][3] = text
         self.add_rows_if_needed(model)
 
     def on_accel_cleared(self, _renderer, path, model):
-        if model[path][0] == model[path][1] == 0:
+        if model[path][3]:
+            model[path][3] = ''
+        elif model[path][0] == model[path][1] == 0:
             model[path][0], model[path][1] = gtk.accelerator_parse('BackSpace')
         else:
             model[path][0] = 0
@@ -764,7 +1147,7 @@ class ShortcutChangeDialog(gtk.Window):
         frame = gtk.Frame()
         box.pack_start(frame)
 
-        model = gtk.ListStore(int, int, int)
+        model = gtk.ListStore(int, int, int, str)
         view = gtk.TreeView(model)
         view.set_headers_visible(False)
         view.set_border_width(5)
@@ -783,24 +1166,35 @@ class ShortcutChangeDialog(gtk.Window):
         cell.connect('edited', self.on_priority_edited, model)
         view.append_column(gtk.TreeViewColumn('priority', cell, text=2))
 
-        for (key, mod), pr  in items:
-            model.append((key, mod, pr))
+        cell = gtk.CellRendererText()
+        cell.props.editable = True
+        cell.connect('edited', self.on_sequence_edited, model)
+        view.append_column(gtk.TreeViewColumn('sequence', cell, text=3))
+
+        for km, pr  in items:
+            if is_sequence(km):
+                model.append((0, 0, pr, accel_name(km)))
+            else:
+                model.append((km[0], km[1], pr, ''))
 
-        model.append((0, 0, 0))
+        model.append((0, 0, 0, ''))
 
         return box, model
 
     def get_keys(self, model):
         for r in model:
-            if r[0]:
+            if r[3]:
+                yield parse_accel(r[3])[0], r[2]
+            elif r[0]:
                 yield (r[0], r[1]), r[2]
 
     def quit(self, *args):
         ctx, name = self.acontext
-        if self.default_model:
-            self.activator.keymap.replace_generics(name, list(self.get_keys(self.default_model)))
+        with self.activator.batch():
+            if self.default_model:
+                self.activator.keymap.replace_generics(name, list(self.get_keys(self.default_model)))
 
-        self.activator.replace_keys(ctx, name, list(self.get_keys(self.ctx_model)))
+            self.activator.replace_keys(ctx, name, list(self.get_keys(self.ctx_model)))
         self.activator.keymap.save()
 
     def on_key_press_event(self, _window, event):
@@ -810,3 +1204,98 @@ class ShortcutChangeDialog(gtk.Window):
             return True
 
         return False
+
+
+class CommandPalette(gtk.Window):
+    def __init__(self, activator, window):
+        gtk.Window.__init__(self, gtk.WINDOW_TOPLEVEL)
+        self.set_modal(True)
+        self.set_transient_for(window)
+        self.set_position(gtk.WIN_POS_CENTER_ON_PARENT)
+        self.set_title('Commands')
+        self.set_default_size(500, 400)
+        self.set_border_width(5)
+        self.connect('delete-event', self.quit)
+
+        self.activator = activator
+        self.window = window
+        self.ctx_getter = activator.make_context_getter(window)
+        self.dynamic_items = list(activator.command_index.get_dynamic_items(self.ctx_getter))
+
+        box = gtk.VBox(False, 5)
+        self.add(box)
+
+        self.entry = gtk.Entry()
+        self.entry.connect('changed', self.on_entry_changed)
+        self.entry.connect('key-press-event', self.on_entry_key_press)
+        box.pack_start(self.entry, False, False)
+
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        sw.set_shadow_type(gtk.SHADOW_IN)
+        box.pack_start(sw)
+
+        self.model = gtk.ListStore(str, str, object)
+        self.view = gtk.TreeView(self.model)
+        self.view.set_headers_visible(False)
+        self.view.connect('row-activated', self.on_row_activated)
+        sw.add(self.view)
+
+        cell = gtk.CellRendererText()
+        column = gtk.TreeViewColumn('title', cell, text=0)
+        column.set_expand(True)
+        self.view.append_column(column)
+
+        cell = gtk.CellRendererText()
+        cell.props.xalign = 1
+        cell.props.foreground = self.view.style.fg[gtk.STATE_INSENSITIVE].to_string()
+        self.view.append_column(gtk.TreeViewColumn('accel', cell, text=1))
+
+        self.fill()
+
+    def fill(self):
+        activator = self.activator
+        entries = activator.command_index.search(self.entry.get_text(), self.ctx_getter,
+            extra=self.dynamic_items)
+
+        self.view.set_model(None)
+        self.model.clear()
+        for entry in entries:
+            km = activator.get_km_for_action(entry.ctx, entry.name)
+            title = getattr(entry, 'path', None) or entry.title.replace('_', '')
+            accel = ', '.join(get_accel_label(r[0]) for r in km)
+            self.model.append((title, accel, entry))
+
+        self.view.set_model(self.model)
+        if entries:
+            self.view.set_cursor((0,))
+
+    def on_entry_changed(self, entry):
+        self.fill()
+
+    def on_entry_key_press(self, entry, event):
+        if event.keyval == Escape:
+            self.quit()
+            return True
+
+        if event.keyval in (gtk.keysyms.Return, gtk.keysyms.KP_Enter):
+            path, _ = self.view.get_cursor()
+            if path:
+                self.on_row_activated(self.view, path, None)
+            return True
+
+        if event.keyval in (gtk.keysyms.Up, gtk.keysyms.Down,
+                gtk.keysyms.Page_Up, gtk.keysyms.Page_Down):
+            self.view.event(event)
+            return True
+
+        return False
+
+    def on_row_activated(self, view, path, _column):
+        entry = self.model[path][2]
+        self.quit()
+        self.activator.run_command(self.window, entry, self.ctx_getter)
+
+    def quit(self, *args):
+        self.hide()
+        self.destroy()
@@ -0,0 +1,9 @@
+class CancelToken(object):
+    def __init__(self):
+        self.cancelled = False
+        # Providers clear it if results can't be narrowed by filtering,
+        # e.g. when they are truncated
+        self.refinable = True
+
+    def cancel(self):
+        self.cancelled = True
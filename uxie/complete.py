@@ -1,10 +1,173 @@
 import gtk
+import glib
+import gobject
+import threading
+from Queue import Queue
+from collections import OrderedDict
 from time import time
 from contextlib import contextmanager
+from heapq import merge
+from itertools import islice
 
-from .utils import send_focus_change, refresh_gui, idle
+from .utils import send_focus_change, refresh_gui
+from .tree import VirtualListModel
+from .profiler import Histogram
+from .cancel import CancelToken
 
 ACTIVATE_ROW_KEYS = set((gtk.keysyms.Return, gtk.keysyms.ISO_Enter, gtk.keysyms.KP_Enter))
+FILL_BATCH_SIZE = 100
+FILL_BATCH_DELAY = 0.05
+REFINE_CACHE_SIZE = 16
+VIRTUAL_MEASURE_ROWS = 50
+PROVIDER_LIMIT = 100
+
+# Fill workers need it before gtk.main(), otherwise the main loop holds
+# GIL while polling and worker threads starve
+gobject.threads_init()
+
+
+class CompletionStats(object):
+    """Completer request counters
+
+    ``discarded`` requests were replaced by newer ones before their fill
+    started, ``cancelled`` fetches were stopped while running. ``latency``
+    is a histogram of times from request to shown popup.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.fills = 0
+        self.discarded = 0
+        self.cancelled = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'fills': self.fills,
+            'discarded': self.discarded,
+            'cancelled': self.cancelled,
+            'latency': self.latency.as_dict(),
+        }
+
+
+class RefineCache(object):
+    """Completion rows of recent queries
+
+    Rows for a query extending the last one are found by filtering the
+    last rows with ``match_cb(query, row)``. Other queries are served from
+    LRU of ``size`` recent ones or need a full fill.
+    """
+    def __init__(self, match_cb, size=REFINE_CACHE_SIZE):
+        self.match_cb = match_cb
+        self.size = size
+        self.recent = OrderedDict()
+        self.last = None
+
+    def get(self, query):
+        try:
+            rows, refinable = self.recent.pop(query)
+        except KeyError:
+            pass
+        else:
+            self.recent[query] = rows, refinable
+            self.last = query, rows, refinable
+            return rows
+
+        if self.last:
+            last_query, last_rows, refinable = self.last
+            if refinable and query.startswith(last_query):
+                match = self.match_cb
+                rows = [r for r in last_rows if match(query, r)]
+                self.put(query, rows)
+                return rows
+
+        return None
+
+    def put(self, query, rows, refinable=True):
+        self.recent.pop(query, None)
+        self.recent[query] = rows, refinable
+        if len(self.recent) > self.size:
+            self.recent.popitem(False)
+
+        self.last = query, rows, refinable
+
+    def invalidate(self):
+        self.recent.clear()
+        self.last = None
+
+
+def tag_ranked(source, index):
+    # Provider index breaks score ties before rows are compared
+    for score, row in source:
+        yield score, index, row
+
+def merge_ranked(sources, limit=PROVIDER_LIMIT):
+    """Returns top ``limit`` rows of ranked sources
+
+    Every source yields (score, row) pairs in ascending score order and is
+    consumed only as far as needed.
+    """
+    ranked = merge(*[tag_ranked(s, i) for i, s in enumerate(sources)])
+    return [r[2] for r in islice(ranked, limit)]
+
+def limit_provider(fetch_cb, index, limit):
+    def fetch(token, query):
+        return islice(tag_ranked(fetch_cb(token, query), index), limit)
+
+    return fetch
+
+
+class FillWorker(object):
+    """Runs completion fetches in a daemon thread
+
+    Rows produced by ``fetch_cb(token, query)`` are passed to ``on_batch``
+    in the main loop every ``batch_size`` rows or ``batch_delay`` seconds.
+    ``on_done`` is called after the last batch. Cancelled requests are
+    skipped or stopped between rows.
+    """
+    def __init__(self, batch_size=FILL_BATCH_SIZE, batch_delay=FILL_BATCH_DELAY):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = Queue()
+        self.thread = None
+
+    def submit(self, token, fetch_cb, query, on_batch, on_done):
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run, name='uxie-completion')
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.queue.put((token, fetch_cb, query, on_batch, on_done))
+
+    def run(self):
+        while True:
+            self.fetch(*self.queue.get())
+
+    def fetch(self, token, fetch_cb, query, on_batch, on_done):
+        if token.cancelled:
+            return
+
+        batch = []
+        t = time()
+        try:
+            for row in fetch_cb(token, query):
+                if token.cancelled:
+                    return
+
+                batch.append(row)
+                if len(batch) >= self.batch_size or time() - t > self.batch_delay:
+                    glib.idle_add(on_batch, token, batch)
+                    batch = []
+                    t = time()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+        if batch:
+            glib.idle_add(on_batch, token, batch)
+
+        glib.idle_add(on_done, token)
+
 
 class Completer(gtk.Window):
     def __init__(self, view):
@@ -26,6 +189,14 @@ class Completer(gtk.Window):
         self.pass_enter_key = False
 
         self.active = False
+        self.worker = None
+        self.provider_workers = []
+        self.fill_token = None
+        self.fill_started = False
+        # Milliseconds to wait for more keystrokes, 0 fills on idle
+        self.fill_delay = 0
+        self.fill_time = None
+        self.stats = CompletionStats()
 
     def request_fill(self, widget, check, args):
         try:
@@ -43,11 +214,225 @@ class Completer(gtk.Window):
                 self.view.set_cursor((0,))
                 self.view.get_selection().unselect_all()
                 self.view.window.thaw_updates()
+                self.record_latency()
             else:
                 self.popdown(widget)
 
+    def request_fetch(self, widget, args):
+        query = widget.completer_query_cb(self.view, widget, *args)
+        if query is None:
+            self.popdown(widget)
+            return
+
+        refine = getattr(widget, 'completer_refine', None)
+        if refine:
+            rows = refine.get(query)
+            if rows is not None:
+                self.set_rows(widget, rows)
+                return
+
+        if not self.worker:
+            self.worker = FillWorker()
+
+        self.fill_token = CancelToken()
+        self.fill_token.query = query
+        self.fill_token.rows = [] if refine else None
+        self.fill_started = False
+        self.worker.submit(self.fill_token, widget.completer_fetch_cb, query,
+            lambda token, rows: self.add_rows(widget, token, rows),
+            lambda token: self.finish_fetch(widget, token))
+
+    def add_rows(self, widget, token, rows):
+        if token is not self.fill_token:
+            return False
+
+        if token.rows is not None:
+            token.rows.extend(rows)
+
+        if self.fill_started:
+            model = self.view.get_model()
+            for r in rows:
+                model.append(r)
+
+            self.set_position(widget)
+        else:
+            self.fill_started = True
+            self.set_rows(widget, rows)
+
+        return False
+
+    def request_merge(self, widget, args):
+        query = widget.completer_query_cb(self.view, widget, *args)
+        if query is None:
+            self.popdown(widget)
+            return
+
+        providers = widget.completer_providers
+        while len(self.provider_workers) < len(providers):
+            self.provider_workers.append(FillWorker())
+
+        # Every provider has its own worker, so slow ones don't delay
+        # results of the others
+        token = self.fill_token = CancelToken()
+        token.rows = None
+        token.ranked = []
+        token.pending = len(providers)
+        self.fill_started = False
+        limit = widget.completer_limit
+        for i, fetch_cb in enumerate(providers):
+            self.provider_workers[i].submit(token, limit_provider(fetch_cb, i, limit), query,
+                lambda token, ranked: self.merge_rows(widget, token, ranked),
+                lambda token: self.finish_merge(widget, token))
+
+    def merge_rows(self, widget, token, ranked):
+        if token is not self.fill_token:
+            return False
+
+        old = token.ranked
+        token.ranked = list(islice(merge(old, ranked), widget.completer_limit))
+        if self.fill_started:
+            if token.ranked[:len(old)] == old:
+                model = self.view.get_model()
+                for r in token.ranked[len(old):]:
+                    model.append(r[2])
+            else:
+                self.refill_model(old, token.ranked)
+
+            self.set_position(widget)
+        else:
+            self.fill_started = True
+            self.set_rows(widget, [r[2] for r in token.ranked])
+
+        return False
+
+    def finish_merge(self, widget, token):
+        if token is not self.fill_token:
+            return False
+
+        token.pending -= 1
+        if token.pending:
+            return False
+
+        return self.finish_fetch(widget, token)
+
+    def refill_model(self, old, ranked):
+        # Better rows arrived while user may be moving cursor, it stays
+        # on the same row
+        view = self.view
+        path = view.get_cursor()[0]
+        if path and path[0] < len(old) and view.get_selection().count_selected_rows():
+            row = old[path[0]]
+        else:
+            row = None
+
+        self.fill_model([r[2] for r in ranked])
+        if row is not None and row in ranked:
+            if self.active:
+                view.handler_block(self.cursor_changed_handler_id)
+
+            try:
+                view.set_cursor((ranked.index(row),))
+            finally:
+                if self.active:
+                    view.handler_unblock(self.cursor_changed_handler_id)
+        else:
+            self.reset_cursor()
+
+    def reset_cursor(self):
+        self.view.window.freeze_updates()
+        self.view.set_cursor((0,))
+        self.view.get_selection().unselect_all()
+        self.view.window.thaw_updates()
+
+    def fill_model(self, rows):
+        fill_view(self.view, rows)
+
+    def set_rows(self, widget, rows):
+        self.fill_model(rows)
+        if not rows:
+            self.popdown(widget)
+            return
+
+        if self.active:
+            self.set_position(widget)
+        else:
+            self.popup(widget)
+
+        self.reset_cursor()
+        self.record_latency()
+
+    def record_latency(self):
+        if self.fill_time is not None:
+            self.stats.latency.add(time() - self.fill_time)
+            self.fill_time = None
+
+    def finish_fetch(self, widget, token):
+        if token is not self.fill_token:
+            return False
+
+        self.fill_token = None
+        if token.rows is not None:
+            widget.completer_refine.put(token.query, token.rows, token.refinable)
+
+        if not self.fill_started:
+            self.view.get_model().clear()
+            self.popdown(widget)
+
+        return False
+
+    def cancel_fetch(self):
+        if self.fill_token:
+            self.fill_token.cancel()
+            self.fill_token = None
+
+    def set_delay(self, widget, delay):
+        # Per widget fill_delay override
+        widget.completer_delay = delay
+
     def complete(self, widget, *args):
-        idle(self.request_fill, widget, self.is_stop(widget), args)
+        # At most one fill is pending per widget, newer request replaces it
+        self.stats.requests += 1
+        if self.cancel_pending(widget):
+            self.stats.discarded += 1
+
+        delay = getattr(widget, 'completer_delay', None)
+        if delay is None:
+            delay = self.fill_delay
+
+        if delay:
+            source = glib.timeout_add(delay, self.run_pending, widget)
+        else:
+            source = glib.idle_add(self.run_pending, widget)
+
+        widget.completer_pending = source, args, time()
+
+    def cancel_pending(self, widget):
+        pending = getattr(widget, 'completer_pending', None)
+        if pending:
+            glib.source_remove(pending[0])
+            widget.completer_pending = None
+            return True
+
+        return False
+
+    def run_pending(self, widget):
+        _, args, self.fill_time = widget.completer_pending
+        widget.completer_pending = None
+        self.stats.fills += 1
+
+        # Newer request makes results of a running one useless
+        if self.fill_token:
+            self.stats.cancelled += 1
+            self.cancel_fetch()
+
+        if getattr(widget, 'completer_providers', None):
+            self.request_merge(widget, args)
+        elif getattr(widget, 'completer_fetch_cb', None):
+            self.request_fetch(widget, args)
+        else:
+            self.request_fill(widget, self.is_stop(widget), args)
+
+        return False
 
     def on_key_press_event(self, widget, event):
         keymap = gtk.gdk.keymap_get_default()
@@ -56,6 +441,7 @@ class Completer(gtk.Window):
         t = gtk.gdk.keyval_to_unicode(keyval)
 
         if keyval == gtk.keysyms.Escape:
+            self.cancel_pending(widget)
             self.popdown(widget)
             return True
 
@@ -97,9 +483,11 @@ class Completer(gtk.Window):
             'focus-out-event', self.on_main_window_focus_out, widget)
 
     def on_main_window_focus_out(self, window, event, widget):
+        self.cancel_pending(widget)
         self.popdown(widget)
 
     def popdown(self, widget):
+        self.cancel_fetch()
         if not self.active:
             return
 
@@ -165,6 +553,33 @@ class Completer(gtk.Window):
         textview.completer_fill_cb = fill_cb
         textview.completer_activate_cb = activate_cb
 
+    def attach_async(self, widget, query_cb, fetch_cb, activate_cb, match_cb=None):
+        # query_cb(view, widget, *args) runs in the main loop and returns
+        # query for fetch_cb or None to hide popup. fetch_cb(token, query)
+        # runs in a worker thread and yields model rows, it should stop
+        # when token.cancelled becomes true. With match_cb(query, row)
+        # string queries are refined from previous results, see RefineCache.
+        self.attach(widget, None, activate_cb)
+        widget.completer_query_cb = query_cb
+        widget.completer_fetch_cb = fetch_cb
+        widget.completer_refine = RefineCache(match_cb) if match_cb else None
+
+    def attach_providers(self, widget, query_cb, providers, activate_cb, limit=PROVIDER_LIMIT):
+        # Like attach_async, but providers are several fetch_cb yielding
+        # (score, row) pairs in ascending score order. Popup shows merged
+        # top ``limit`` rows as they arrive, each provider is read
+        # only up to ``limit`` rows.
+        self.attach(widget, None, activate_cb)
+        widget.completer_query_cb = query_cb
+        widget.completer_providers = providers
+        widget.completer_limit = limit
+
+    def invalidate(self, widget):
+        # Providers call it when their data changes
+        refine = getattr(widget, 'completer_refine', None)
+        if refine:
+            refine.invalidate()
+
 
 class EntryCompleter(Completer):
     def set_position(self, entry):
@@ -249,9 +664,52 @@ class TextViewCompleter(Completer):
         self.move(x, y)
         self.resize(*self.size_request())
 
-def create_simple_complete_view():
-    model = gtk.ListStore(str)
+def fit_column_width(view, rows):
+    # Virtual views have fixed column width, it is measured on first rows
+    # only to not touch all of them
+    column = view.get_column(0)
+    layout = view.create_pango_layout('')
+    width = 0
+    for r in rows[:VIRTUAL_MEASURE_ROWS]:
+        if getattr(view, 'text_column_is_markup', False):
+            layout.set_markup(r[1])
+        else:
+            layout.set_text(r[0])
+
+        width = max(width, layout.get_pixel_size()[0])
+
+    column.set_fixed_width(width + 2 * column.get_cell_renderers()[0].props.xpad + 8)
+
+def fill_view(view, rows):
+    model = view.get_model()
+    if isinstance(model, VirtualListModel):
+        model.replace(view, rows)
+        fit_column_width(view, rows)
+    else:
+        model.clear()
+        for r in rows:
+            model.append(r)
+
+def create_simple_complete_view(markup=False, virtual=False):
+    # With markup rows are (text, markup), e.g. from uxie.fuzzy.Matcher.fetch.
+    # Virtual view is backed by VirtualListModel, fill it with
+    # Completer.set_rows or fill_view(view, rows), raw model.replace
+    # leaves the fixed column unsized.
+    types = (str, str) if markup else (str,)
+    model = VirtualListModel(*types) if virtual else gtk.ListStore(*types)
+
+    if markup:
+        column = gtk.TreeViewColumn('title', gtk.CellRendererText(), markup=1)
+    else:
+        column = gtk.TreeViewColumn('title', gtk.CellRendererText(), text=0)
+
     view = gtk.TreeView(model)
     view.set_headers_visible(False)
-    view.append_column(gtk.TreeViewColumn('title', gtk.CellRendererText(), text=0))
+    view.append_column(column)
+    view.text_column_is_markup = markup
+
+    if virtual:
+        column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        view.set_fixed_height_mode(True)
+
     return view
\ No newline at end of file
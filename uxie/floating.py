@@ -1,25 +1,30 @@
 import time
 import weakref
+from heapq import heappush, heappop
+from itertools import count
+
 import gtk
 import glib
 
 from .misc import FlatBox
 
-def floating_timeout(floating):
-    floating = floating()
-    if floating and floating.is_active():
-        floating.cancel()
-
-    return False
+# Seconds, deadlines this close expire in the same tick
+TIMEOUT_RESOLUTION = 0.05
 
 
 class Manager(object):
     def __init__(self):
         self.floatings = weakref.WeakKeyDictionary()
+        # Heap of (deadline, seq, floating ref, parent ref) driven by
+        # single glib source armed for the nearest deadline
+        self.timeouts = []
+        self.timeout_seq = count()
+        self.timer = None
+        self.timer_deadline = None
 
     def add(self, parent, floating, priority=None, timeout=None, place_vertically=True):
         if timeout:
-            glib.timeout_add(timeout, floating_timeout, weakref.ref(floating))
+            self.schedule(parent, floating, timeout)
 
         if priority is None:
             priority = 0
@@ -30,6 +35,47 @@ class Manager(object):
         self.arrange(parent)
         return floating
 
+    def schedule(self, parent, floating, timeout):
+        deadline = time.time() + timeout / 1000.0
+        heappush(self.timeouts, (deadline, next(self.timeout_seq),
+            weakref.ref(floating), weakref.ref(parent)))
+
+        if self.timer_deadline is None or deadline < self.timer_deadline:
+            self.arm_timer()
+
+    def arm_timer(self):
+        if self.timer:
+            glib.source_remove(self.timer)
+            self.timer = None
+
+        if self.timeouts:
+            self.timer_deadline = self.timeouts[0][0]
+            delay = max(0, int((self.timer_deadline - time.time()) * 1000))
+            self.timer = glib.timeout_add(delay, self.expire)
+        else:
+            self.timer_deadline = None
+
+    def expire(self):
+        now = time.time() + TIMEOUT_RESOLUTION
+        parents = []
+        while self.timeouts and self.timeouts[0][0] <= now:
+            _, _, floating, parent = heappop(self.timeouts)
+            floating = floating()
+            if floating and floating.is_active():
+                floating.cancel()
+                parent = parent()
+                if parent is not None and parent not in parents:
+                    parents.append(parent)
+
+        self.timer = None
+        self.arm_timer()
+
+        for p in parents:
+            if p in self.floatings:
+                self.arrange(p)
+
+        return False
+
     def arrange(self, parent):
         floatings = self.floatings[parent][:] = [
             r for r in self.floatings[parent] if r[3].is_active()]
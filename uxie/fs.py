@@ -0,0 +1,49 @@
+import os
+from os.path import join, dirname, basename, exists, expanduser
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+def join_to_file_dir(filename, *args):
+    return join(dirname(filename), *args)
+
+def join_to_settings_dir(*args):
+    config_dir = os.getenv('XDG_CONFIG_HOME', expanduser('~/.config'))
+    return join(config_dir, *args)
+
+def join_to_data_dir(*args):
+    config_dir = os.getenv('XDG_DATA_HOME', expanduser('~/.local/share'))
+    return join(config_dir, *args)
+
+def join_to_cache_dir(*args):
+    config_dir = os.getenv('XDG_CACHE_HOME', expanduser('~/.cache'))
+    return join(config_dir, *args)
+
+def make_missing_dirs(filename):
+    path = dirname(filename)
+    if not exists(path):
+        os.makedirs(path, mode=0755)
+
+def get_file_mode(filename):
+    # Mode a plain open would give, mkstemp always creates 0600 files
+    try:
+        return os.stat(filename).st_mode & 07777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
+
+@contextmanager
+def atomic_open(filename, mode='w'):
+    make_missing_dirs(filename)
+    fd, tmpname = mkstemp(dir=dirname(filename), prefix='.' + basename(filename))
+    try:
+        os.fchmod(fd, get_file_mode(filename))
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
@@ -0,0 +1,163 @@
+"""Fuzzy subsequence matcher for large completion lists
+
+Candidates are lowercased once and get a character bitmask, so most of
+them are rejected by a single integer test. Survivors are checked by a
+compiled subsequence regex and the best ``limit`` ones are ranked by
+match compactness, start and length.
+"""
+import re
+from array import array
+from heapq import nsmallest
+from itertools import compress, chain
+from xml.sax.saxutils import escape
+
+MATCH_BATCH_SIZE = 10000
+MATCH_LIMIT = 100
+
+# Masks fit a signed C long to be plain ints in array('l'). With 32 bit
+# longs chars share bits, it only weakens prefiltering.
+MASK_BITS = array('l').itemsize * 8 - 1
+
+def get_char_bit(index):
+    return 1 << (index % MASK_BITS)
+
+CHAR_BITS = {}
+for _i in range(256):
+    _c = chr(_i).lower()
+    if 'a' <= _c <= 'z':
+        CHAR_BITS[chr(_i)] = get_char_bit(ord(_c) - 97)
+    elif '0' <= _c <= '9':
+        CHAR_BITS[chr(_i)] = get_char_bit(26 + ord(_c) - 48)
+    else:
+        CHAR_BITS[chr(_i)] = get_char_bit(36 + _i % 27)
+
+UNKNOWN_CHAR_BIT = get_char_bit(62)
+
+def get_mask(text):
+    mask = 0
+    for c in set(text):
+        try:
+            mask |= CHAR_BITS[c]
+        except KeyError:
+            mask |= UNKNOWN_CHAR_BIT
+
+    return mask
+
+def get_pattern(query):
+    return re.compile('.*?'.join(re.escape(c) for c in query), re.S)
+
+def find_compact(text, query, search):
+    """Returns positions of query chars in the most compact match or None
+
+    Lazy forward match is tightened by backward scan from its end, then
+    later matches are tried until a contiguous one is found.
+    """
+    best = None
+    m = search(text)
+    while m:
+        end = m.end()
+        start = end
+        for c in reversed(query):
+            start = text.rfind(c, 0, start)
+
+        if best is None or end - start < best[1] - best[0]:
+            best = start, end
+            if end - start == len(query):
+                break
+
+        m = search(text, start + 1)
+
+    if best is None:
+        return None
+
+    # Earliest positions inside the window
+    positions = []
+    p = best[0]
+    for c in query:
+        p = text.find(c, p)
+        positions.append(p)
+        p += 1
+
+    return positions
+
+def highlight(text, positions, tag='b'):
+    """Returns pango markup of text with chars at positions wrapped in tag"""
+    result = []
+    last = 0
+    for p in positions:
+        result.append(escape(text[last:p]))
+        result.append('<%s>%s</%s>' % (tag, escape(text[p]), tag))
+        last = p + 1
+
+    result.append(escape(text[last:]))
+    return ''.join(result)
+
+
+class Matcher(object):
+    def __init__(self, candidates, key=None):
+        self.candidates = list(candidates)
+        self.texts = [key(r) for r in self.candidates] if key else self.candidates
+        self.lower = [r.lower() for r in self.texts]
+        self.masks = array('l', (get_mask(r) for r in self.lower))
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def match(self, query, limit=MATCH_LIMIT, token=None):
+        """Returns best (candidate, positions) pairs, best first
+
+        Empty query matches first ``limit`` candidates. Candidates are
+        processed in batches of MATCH_BATCH_SIZE, None is returned if
+        token gets cancelled meanwhile. token.refinable is cleared if
+        results are truncated.
+        """
+        result = self.match_indexes(query, limit, token)
+        if result is None:
+            return None
+
+        candidates = self.candidates
+        return [(candidates[i], positions) for i, positions in result]
+
+    def match_indexes(self, query, limit=MATCH_LIMIT, token=None):
+        query = query.lower()
+        if not query:
+            return [(i, []) for i in xrange(min(limit, len(self.lower)))]
+
+        qmask = get_mask(query)
+        search = get_pattern(query).search
+        lower = self.lower
+        masks = self.masks
+
+        best = []
+        total = 0
+        for start in xrange(0, len(lower), MATCH_BATCH_SIZE):
+            if token and token.cancelled:
+                return None
+
+            end = start + MATCH_BATCH_SIZE
+            found = []
+            for i in compress(xrange(start, end), [m & qmask == qmask for m in masks[start:end]]):
+                text = lower[i]
+                positions = find_compact(text, query, search)
+                if positions:
+                    # Compact matches first, then earlier and shorter ones
+                    s = positions[0]
+                    found.append((positions[-1] + 1 - s, s, len(text), i, positions))
+
+            total += len(found)
+            best = nsmallest(limit, chain(best, found))
+
+        if token and total > limit:
+            token.refinable = False
+
+        return [(r[3], r[4]) for r in best]
+
+    def fetch(self, token, query, limit=MATCH_LIMIT):
+        """Completer.attach_async fetch_cb yielding (text, markup) rows
+
+        Rows fit ``create_simple_complete_view(markup=True)``. Truncated
+        results are marked not refinable for RefineCache.
+        """
+        texts = self.texts
+        for i, positions in self.match_indexes(query, limit, token) or ():
+            yield texts[i], highlight(texts[i], positions)
@@ -0,0 +1,888 @@
+# -*- coding: utf-8 -*-
+"""GTK-free keymap core
+
+Accelerator parsing, keymap config handling, shortcut tables and context
+resolution. :mod:`uxie.actions` binds them to GTK windows and menus.
+"""
+import os
+import ast
+import hashlib
+import weakref
+import cPickle as pickle
+from time import time
+from bisect import bisect
+from contextlib import contextmanager
+
+from .fs import join_to_cache_dir, atomic_open
+
+ANY_CTX = ('any', )
+DEFAULT_PRIORITY = 0
+FOCUS_EVENT = 'focus'
+DEFAULT_CONTEXT_COST = 1
+BUILTIN_CONTEXTS = ('window', 'activator', 'ctx_getter')
+KEYMAP_CACHE_VERSION = 3
+
+# GdkModifierType values
+SHIFT_MASK = 1 << 0
+LOCK_MASK = 1 << 1
+CONTROL_MASK = 1 << 2
+MOD1_MASK = 1 << 3
+MOD2_MASK = 1 << 4
+MOD3_MASK = 1 << 5
+MOD4_MASK = 1 << 6
+MOD5_MASK = 1 << 7
+SUPER_MASK = 1 << 26
+HYPER_MASK = 1 << 27
+META_MASK = 1 << 28
+RELEASE_MASK = 1 << 30
+DEFAULT_MOD_MASK = SHIFT_MASK | CONTROL_MASK | MOD1_MASK | SUPER_MASK
+
+MODIFIER_NAMES = (
+    (RELEASE_MASK, 'Release'),
+    (SHIFT_MASK, 'Shift'),
+    (CONTROL_MASK, 'Control'),
+    (MOD1_MASK, 'Alt'),
+    (MOD2_MASK, 'Mod2'),
+    (MOD3_MASK, 'Mod3'),
+    (MOD4_MASK, 'Mod4'),
+    (MOD5_MASK, 'Mod5'),
+    (META_MASK, 'Meta'),
+    (SUPER_MASK, 'Super'),
+    (HYPER_MASK, 'Hyper'),
+)
+
+MODIFIERS = dict((name.lower(), mask) for mask, name in MODIFIER_NAMES)
+MODIFIERS.update({'ctrl': CONTROL_MASK, 'ctl': CONTROL_MASK, 'primary': CONTROL_MASK,
+    'shft': SHIFT_MASK, 'mod1': MOD1_MASK})
+
+# X11 keysym names, first name of a keyval is used by accel_name
+KEYSYMS = [
+    ('space', 0x20), ('exclam', 0x21), ('quotedbl', 0x22), ('numbersign', 0x23),
+    ('dollar', 0x24), ('percent', 0x25), ('ampersand', 0x26), ('apostrophe', 0x27),
+    ('quoteright', 0x27), ('parenleft', 0x28), ('parenright', 0x29), ('asterisk', 0x2a),
+    ('plus', 0x2b), ('comma', 0x2c), ('minus', 0x2d), ('period', 0x2e), ('slash', 0x2f),
+    ('colon', 0x3a), ('semicolon', 0x3b), ('less', 0x3c), ('equal', 0x3d),
+    ('greater', 0x3e), ('question', 0x3f), ('at', 0x40), ('bracketleft', 0x5b),
+    ('backslash', 0x5c), ('bracketright', 0x5d), ('asciicircum', 0x5e),
+    ('underscore', 0x5f), ('grave', 0x60), ('quoteleft', 0x60), ('braceleft', 0x7b),
+    ('bar', 0x7c), ('braceright', 0x7d), ('asciitilde', 0x7e),
+
+    ('BackSpace', 0xff08), ('Tab', 0xff09), ('Linefeed', 0xff0a), ('Clear', 0xff0b),
+    ('Return', 0xff0d), ('Pause', 0xff13), ('Scroll_Lock', 0xff14), ('Sys_Req', 0xff15),
+    ('Escape', 0xff1b), ('Delete', 0xffff), ('Home', 0xff50), ('Left', 0xff51),
+    ('Up', 0xff52), ('Right', 0xff53), ('Down', 0xff54), ('Page_Up', 0xff55),
+    ('Prior', 0xff55), ('Page_Down', 0xff56), ('Next', 0xff56), ('End', 0xff57),
+    ('Begin', 0xff58), ('Select', 0xff60), ('Print', 0xff61), ('Execute', 0xff62),
+    ('Insert', 0xff63), ('Undo', 0xff65), ('Redo', 0xff66), ('Menu', 0xff67),
+    ('Find', 0xff68), ('Cancel', 0xff69), ('Help', 0xff6a), ('Break', 0xff6b),
+    ('Num_Lock', 0xff7f), ('ISO_Left_Tab', 0xfe20), ('ISO_Enter', 0xfe34),
+
+    ('KP_Space', 0xff80), ('KP_Tab', 0xff89), ('KP_Enter', 0xff8d), ('KP_Home', 0xff95),
+    ('KP_Left', 0xff96), ('KP_Up', 0xff97), ('KP_Right', 0xff98), ('KP_Down', 0xff99),
+    ('KP_Page_Up', 0xff9a), ('KP_Prior', 0xff9a), ('KP_Page_Down', 0xff9b),
+    ('KP_Next', 0xff9b), ('KP_End', 0xff9c), ('KP_Begin', 0xff9d), ('KP_Insert', 0xff9e),
+    ('KP_Delete', 0xff9f), ('KP_Multiply', 0xffaa), ('KP_Add', 0xffab),
+    ('KP_Separator', 0xffac), ('KP_Subtract', 0xffad), ('KP_Decimal', 0xffae),
+    ('KP_Divide', 0xffaf), ('KP_Equal', 0xffbd),
+
+    ('Shift_L', 0xffe1), ('Shift_R', 0xffe2), ('Control_L', 0xffe3), ('Control_R', 0xffe4),
+    ('Caps_Lock', 0xffe5), ('Shift_Lock', 0xffe6), ('Meta_L', 0xffe7), ('Meta_R', 0xffe8),
+    ('Alt_L', 0xffe9), ('Alt_R', 0xffea), ('Super_L', 0xffeb), ('Super_R', 0xffec),
+    ('Hyper_L', 0xffed), ('Hyper_R', 0xffee),
+]
+KEYSYMS.extend(('KP_%d' % i, 0xffb0 + i) for i in range(10))
+KEYSYMS.extend(('KP_F%d' % i, 0xff90 + i) for i in range(1, 5))
+KEYSYMS.extend(('F%d' % i, 0xffbd + i) for i in range(1, 36))
+
+keyvals = {}
+keyval_names = {}
+for _name, _keyval in KEYSYMS:
+    keyvals[_name] = _keyval
+    keyval_names.setdefault(_keyval, _name)
+
+MODIFIER_KEYS = set(keyvals[r] for r in ('Control_L', 'Control_R', 'Alt_L', 'Alt_R',
+    'Shift_L', 'Shift_R', 'Super_L', 'Super_R'))
+
+accel_cache = {}
+accel_names = {}
+
+
+def keyval_to_lower(keyval):
+    if 0x41 <= keyval <= 0x5a or 0xc0 <= keyval <= 0xde and keyval != 0xd7:
+        return keyval + 0x20
+
+    if keyval & 0x1000000:
+        lower = ord(unichr(keyval & 0xffffff).lower())
+        return lower if lower <= 0xff else lower | 0x1000000
+
+    return keyval
+
+def keyval_from_name(name):
+    try:
+        return keyvals[name]
+    except KeyError:
+        pass
+
+    if len(name) == 1 and 0x20 < ord(name) <= 0xff:
+        return ord(name)
+
+    if name[:1] == 'U' and len(name) > 1:
+        try:
+            code = int(name[1:].lstrip('+'), 16)
+        except ValueError:
+            return 0
+
+        return code if code <= 0xff else code | 0x1000000
+
+    # Keyvals without known name, see keyval_name
+    if name[:2] == '0x':
+        try:
+            return int(name, 16)
+        except ValueError:
+            return 0
+
+    return 0
+
+def keyval_name(keyval):
+    try:
+        return keyval_names[keyval]
+    except KeyError:
+        pass
+
+    if 0x20 < keyval <= 0xff:
+        return chr(keyval)
+
+    if keyval & 0x1000000:
+        return 'U%04X' % (keyval & 0xffffff)
+
+    return '0x%x' % keyval if keyval else ''
+
+def parse_key(accel):
+    """Headless gtk.accelerator_parse, returns (0, 0) for invalid accels
+
+    Only names from KEYSYMS, Latin-1 chars, Unicode (U+XXXX) and hex keyvals
+    are known. uxie.actions installs GTK parser with set_key_parser.
+    """
+    mods = 0
+    rest = accel.strip()
+    while rest.startswith('<'):
+        name, sep, rest = rest[1:].partition('>')
+        if not sep or name.lower() not in MODIFIERS:
+            return 0, 0
+
+        mods |= MODIFIERS[name.lower()]
+
+    keyval = keyval_from_name(rest)
+    if not keyval:
+        return 0, 0
+
+    return keyval_to_lower(keyval), mods
+
+def key_name(keyval, mods):
+    """Headless gtk.accelerator_name, unknown keyvals are named as hex"""
+    name = keyval_name(keyval_to_lower(keyval))
+    return ''.join('<%s>' % r for m, r in MODIFIER_NAMES if mods & m) + name
+
+
+class KeyParser(object):
+    # Single key accelerator functions behind parse_accel and accel_name
+    def __init__(self, parse, name):
+        self.parse = parse
+        self.name = name
+
+key_parser = KeyParser(parse_key, key_name)
+
+def set_key_parser(parse, name):
+    """Replaces headless key parser, memoized results are dropped"""
+    key_parser.parse = parse
+    key_parser.name = name
+    accel_cache.clear()
+    accel_names.clear()
+
+def parse_accel(accel, priority=None):
+    if priority is None:
+        priority = DEFAULT_PRIORITY
+
+    try:
+        km = accel_cache[accel]
+    except KeyError:
+        # Space separated accelerators define key sequence like '<ctrl>x <ctrl>s'
+        parts = accel.split()
+        if len(parts) > 1:
+            km = tuple(key_parser.parse(r) for r in parts)
+        else:
+            km = key_parser.parse(accel)
+
+        accel_cache[accel] = km
+
+    if any(r[0] == 0 for r in (km if is_sequence(km) else (km,))):
+        import warnings
+        warnings.warn("Can't parse %s" % accel)
+
+    return km, priority
+
+def is_sequence(km):
+    return isinstance(km[0], tuple)
+
+def accel_name(km):
+    try:
+        return accel_names[km]
+    except KeyError:
+        pass
+
+    if is_sequence(km):
+        name = ' '.join(key_parser.name(*r) for r in km)
+    else:
+        name = key_parser.name(*km)
+
+    accel_names[km] = name
+    accel_cache.setdefault(name, km)
+    return name
+
+def normalize_context(ctx):
+    if isinstance(ctx, tuple):
+        return ctx
+    else:
+        return (ctx,)
+
+def get_keymap_cache_filename(config_filename):
+    digest = hashlib.md5(os.path.abspath(config_filename)).hexdigest()
+    return join_to_cache_dir('uxie', 'keymap-%s.cache' % digest)
+
+def get_file_stamp(filename):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    return st.st_mtime, st.st_size
+
+def load_keymap_config(filename):
+    with open(filename) as f:
+        source = f.read()
+
+    config = {}
+    try:
+        for node in ast.parse(source, filename).body:
+            target, = node.targets
+            config[target.id] = ast.literal_eval(node.value)
+    except (ValueError, AttributeError):
+        # Not a plain data config, fallback to old behavior
+        config.clear()
+        execfile(filename, {}, config)
+
+    return config
+
+def dump_keymap_config(f, config):
+    for section, data in config.iteritems():
+        if section.startswith('_'):
+            continue
+
+        print >> f, '%s = {' % section
+        for name, shortcuts in data.iteritems():
+            print >> f, '    %s: %s,' % (repr(name), repr(shortcuts))
+        print >> f, '}\n'
+
+
+class KeyMap(object):
+    # Config is written immediately, uxie.actions.KeyMap debounces writes
+    # and cache updates with main loop timers
+    def __init__(self, config_filename=None, cache_filename=None):
+        self.generic_shortcuts = {}
+        self.config = {}
+        self.config_filename = config_filename
+        self.cache_filename = cache_filename
+        self.cache_data = None
+        self.cache_dirty = False
+        self.cached_accels = set()
+
+        if config_filename:
+            if not cache_filename:
+                self.cache_filename = get_keymap_cache_filename(config_filename)
+
+            self._load()
+
+        self.changed_generics = self.config.setdefault('generic', {})
+        self.default_generics = {}
+        self._map_changed_generics()
+
+    def _load(self):
+        self.config.clear()
+        stamp = get_file_stamp(self.config_filename)
+        if self._load_cache(stamp):
+            return
+
+        if stamp:
+            try:
+                self.config.update(load_keymap_config(self.config_filename))
+            except IOError:
+                pass
+            except:
+                import traceback
+                traceback.print_exc()
+                return
+
+        self.cache_data = stamp, pickle.dumps(self.config, pickle.HIGHEST_PROTOCOL)
+        self.cache_dirty = True
+
+    def _load_cache(self, stamp):
+        try:
+            with open(self.cache_filename, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            return False
+
+        if data.get('version') != KEYMAP_CACHE_VERSION or data.get('source') != self.config_filename:
+            return False
+
+        accel_cache.update(data['accels'])
+        self.cached_accels.update(data['accels'])
+        if data['stamp'] != stamp:
+            return False
+
+        self.cache_data = stamp, pickle.dumps(data['config'], pickle.HIGHEST_PROTOCOL)
+        self.config.update(data['config'])
+        return True
+
+    def _update_cache(self):
+        if self.cache_data and (self.cache_dirty
+                or any(r not in self.cached_accels for r in accel_cache)):
+            self.save_cache()
+
+    def save_cache(self):
+        # cache_data holds a snapshot of config file state, not of in-memory
+        # config which can have unsaved changes
+        stamp, config = self.cache_data
+        data = {
+            'version': KEYMAP_CACHE_VERSION,
+            'source': self.config_filename,
+            'stamp': stamp,
+            'config': pickle.loads(config),
+            'accels': accel_cache,
+        }
+
+        try:
+            with atomic_open(self.cache_filename, 'wb') as f:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError):
+            import traceback
+            traceback.print_exc()
+            return
+
+        self.cache_dirty = False
+        self.cached_accels.update(accel_cache)
+
+    def _map_changed_generics(self):
+        for name, r in self.changed_generics.iteritems():
+            for accel, priority in r:
+                self._map_generic(name, accel, priority)
+
+    def _map_generic(self, name, accel, priority=None):
+        self.generic_shortcuts.setdefault(name, []).append(parse_accel(accel, priority))
+
+    def map_generic(self, name, accel, priority=None):
+        self.default_generics.setdefault(name, []).append(parse_accel(accel, priority))
+        if name not in self.changed_generics:
+            self._map_generic(name, accel, priority)
+
+    def get_config_section(self, config_section=None):
+        return self.config.setdefault(config_section, {}) if config_section else {}
+
+    def replace_generics(self, name, keys):
+        if name in self.default_generics and set(self.default_generics[name]) == set(keys):
+            self.changed_generics.pop(name, None)
+        else:
+            if keys or name in self.default_generics:
+                self.changed_generics[name] = [(accel_name(km), pr) for km, pr in keys]
+            else:
+                self.changed_generics.pop(name, None)
+
+        self.generic_shortcuts.setdefault(name, [])[:] = keys
+
+    def save(self):
+        if self.config_filename:
+            self._save()
+
+    def flush(self):
+        pass
+
+    def _save(self):
+        with atomic_open(self.config_filename) as f:
+            dump_keymap_config(f, self.config)
+
+        self.cache_data = (get_file_stamp(self.config_filename),
+            pickle.dumps(self.config, pickle.HIGHEST_PROTOCOL))
+        self.save_cache()
+
+
+class ContextResolver(object):
+    def __init__(self):
+        self.contexts = {}
+        self.cached_contexts = {}
+        self.context_events = {}
+        self.context_cache = weakref.WeakKeyDictionary()
+        self.context_cache_stats = {}
+        self.context_costs = {}
+        self.context_plans = {}
+        self.context_orders = {}
+        self.profiler = None
+
+    def _find_context(self, ctx, cache):
+        if ctx == ANY_CTX:
+            return ()
+
+        if isinstance(ctx, tuple):
+            try:
+                order = self.context_orders[ctx]
+            except KeyError:
+                order = self.context_orders[ctx] = sorted(ctx, key=self.get_context_cost)
+
+            for r in order:
+                if self._find_context(r, cache) is None:
+                    return None
+
+            return tuple(cache[r] for r in ctx)
+
+        try:
+            return cache[ctx]
+        except KeyError:
+            pass
+
+        try:
+            plan = self.context_plans[ctx]
+        except KeyError:
+            plan = self._compile_context_plan(ctx)
+
+        if plan is None:
+            print 'There are no any registered providers for [%s] context' % ctx
+            return None
+
+        # Walk plan backwards to skip dependencies of already cached contexts
+        needed = set((ctx,))
+        for c, depends, _, policy in reversed(plan):
+            if c in needed and c not in cache:
+                if not policy or not self._get_cached_context(c, policy, cache):
+                    needed.update(depends)
+
+        for c, depends, callback, policy in plan:
+            if c in needed and c not in cache:
+                args = [cache[d] for d in depends]
+                if any(r is None for r in args):
+                    result = None
+                else:
+                    result = callback(*args)
+
+                cache[c] = result
+                if policy:
+                    self._set_cached_context(c, policy, cache, result)
+
+                if result is None:
+                    cache[ctx] = None
+                    return None
+
+        return cache[ctx]
+
+    def _get_cached_context(self, ctx, policy, cache):
+        window = cache['window']
+        stats = self.context_cache_stats.setdefault(ctx, [0, 0])
+        try:
+            result, expire = self.context_cache[window][ctx]
+        except (KeyError, TypeError):
+            pass
+        else:
+            if expire is None or expire > time():
+                stats[0] += 1
+                cache[ctx] = result
+                return True
+
+        stats[1] += 1
+        return False
+
+    def _set_cached_context(self, ctx, policy, cache, result):
+        window = cache['window']
+        if window is not None:
+            ttl = policy[1]
+            self.context_cache.setdefault(window, {})[ctx] = (
+                result, time() + ttl if ttl else None)
+
+    def _compile_context_plan(self, ctx):
+        # Topologically ordered (ctx, depends, callback, cache policy) steps
+        # needed to resolve context or None if some provider is missing
+        plan = []
+        visited = set(BUILTIN_CONTEXTS)
+        def visit(c):
+            if c in visited:
+                return True
+
+            try:
+                depends, callback = self.contexts[c]
+            except KeyError:
+                return False
+
+            visited.add(c)
+            depends = depends or ()
+            if not all(visit(d) for d in depends):
+                return False
+
+            if self.profiler:
+                callback = self.profiler.wrap_context(c, callback)
+
+            plan.append((c, depends, callback, self.cached_contexts.get(c)))
+            return True
+
+        result = self.context_plans[ctx] = tuple(plan) if visit(ctx) else None
+        return result
+
+    def get_context_cost(self, ctx):
+        if ctx == ANY_CTX:
+            return 0
+
+        if isinstance(ctx, tuple):
+            return sum(self.get_context_cost(r) for r in ctx)
+
+        try:
+            plan = self.context_plans[ctx]
+        except KeyError:
+            plan = self._compile_context_plan(ctx)
+
+        if not plan:
+            return 0
+
+        return sum(self.context_costs.get(r[0], DEFAULT_CONTEXT_COST) for r in plan)
+
+    def validate_contexts(self):
+        missing = set()
+        for depends, _ in self.contexts.itervalues():
+            for d in depends or ():
+                if d not in self.contexts and d not in BUILTIN_CONTEXTS:
+                    missing.add(d)
+
+        if missing:
+            raise KeyError('There are no any registered providers for [%s] contexts'
+                % ', '.join(sorted(missing)))
+
+    def make_context_getter(self, window):
+        cache = {'window':window, 'activator':self}
+        def ctx_getter(ctx):
+            return self._find_context(ctx, cache)
+
+        cache['ctx_getter'] = ctx_getter
+
+        return ctx_getter
+
+    def _contexts_changed(self):
+        self.context_plans.clear()
+        self.context_orders.clear()
+
+    def add_context(self, ctx, depends, callback, invalidate_on=None, ttl=None, cost=None):
+        # Providers with invalidate_on events (see invalidate_context and
+        # FOCUS_EVENT) or ttl in seconds keep their results per window across
+        # activations. Others are called on every activation. Cost is relative
+        # and is used to check cheap contexts first.
+        if isinstance(depends, str):
+            depends = (depends,)
+
+        stack = list(depends or ())
+        seen = set()
+        while stack:
+            c = stack.pop()
+            if c == ctx:
+                raise ValueError('Context [%s] has cyclic dependencies' % ctx)
+
+            if c not in seen:
+                seen.add(c)
+                stack.extend(self.contexts.get(c, (None,))[0] or ())
+
+        self.contexts[ctx] = depends, callback
+        if cost is None:
+            self.context_costs.pop(ctx, None)
+        else:
+            self.context_costs[ctx] = cost
+
+        self._contexts_changed()
+
+        if isinstance(invalidate_on, str):
+            invalidate_on = (invalidate_on,)
+
+        for ctxs in self.context_events.itervalues():
+            ctxs.discard(ctx)
+
+        if invalidate_on or ttl:
+            self.cached_contexts[ctx] = invalidate_on or (), ttl
+            for event in invalidate_on or ():
+                self.context_events.setdefault(event, set()).add(ctx)
+        else:
+            self.cached_contexts.pop(ctx, None)
+
+    def invalidate_context(self, event, window=None):
+        ctxs = set(self.context_events.get(event, ()))
+        if not ctxs:
+            return
+
+        changed = True
+        while changed:
+            changed = False
+            for ctx, (depends, _) in self.contexts.iteritems():
+                if ctx not in ctxs and any(d in ctxs for d in depends or ()):
+                    ctxs.add(ctx)
+                    changed = True
+
+        if window is None:
+            stores = self.context_cache.values()
+        else:
+            stores = [self.context_cache.get(window, {})]
+
+        for store in stores:
+            for ctx in ctxs:
+                store.pop(ctx, None)
+
+    def get_context_cache_stats(self):
+        hits = misses = 0
+        for h, m in self.context_cache_stats.itervalues():
+            hits += h
+            misses += m
+
+        return hits, misses
+
+
+class ShortcutTable(ContextResolver):
+    """Shortcut to action mapping and dispatch
+
+    Actions are any callables taking ctx_getter. Names starting with ``!``
+    are dynamic entries with ``resolve(ctx_obj, param)`` and ``invalidate()``
+    methods, their params are mapped as ``!name/param``.
+    """
+    def __init__(self, keymap, changed_shortcuts=None):
+        ContextResolver.__init__(self)
+        self.actions = {}
+        self.shortcuts = {}
+        self.dispatch = {}
+        self.action_keys = {}
+        self.connected_keys = set()
+        self.pending_keys = None
+        self.sequence_prefixes = {}
+        self.dynamic_events = {}
+
+        self.keymap = keymap
+        self.generic_shortcuts = keymap.generic_shortcuts
+
+        self.default_shortcuts = {}
+        self.changed_shortcuts = {} if changed_shortcuts is None else changed_shortcuts
+        self._map_changed_shortcuts()
+
+    def _map_changed_shortcuts(self):
+        if self.changed_shortcuts:
+            with self.batch():
+                for (ctx, name), r in self.changed_shortcuts.iteritems():
+                    for accel, priority in r:
+                        self._map(ctx, name, accel, priority)
+
+    def _add_shortcut(self, km, ctx, name, priority, is_generic=False):
+        shortcuts = self.shortcuts.setdefault(km, [])
+        shortcuts.insert(bisect(shortcuts, priority), (priority, ctx, name, is_generic))
+        self.action_keys.setdefault((ctx, name), []).append((km, priority, is_generic))
+        if is_sequence(km):
+            self._update_sequence_prefixes(km, ctx, priority, 1)
+
+        self._key_changed(km)
+
+    def _update_sequence_prefixes(self, seq, ctx, priority, delta):
+        # Flattened prefix trie: prefix -> {ctx: {priority: count of sequences
+        # under it}}, priorities are negated like in shortcuts
+        for i in range(1, len(seq)):
+            prefix = seq[:i]
+            contexts = self.sequence_prefixes.setdefault(prefix, {})
+            priorities = contexts.setdefault(ctx, {})
+            count = priorities.get(priority, 0) + delta
+            if count > 0:
+                priorities[priority] = count
+            else:
+                priorities.pop(priority, None)
+                if not priorities:
+                    del contexts[ctx]
+                    if not contexts:
+                        del self.sequence_prefixes[prefix]
+
+    def get_prefix_priority(self, prefix):
+        # Highest priority of sequences starting with prefix
+        return -min(p for r in self.sequence_prefixes[prefix].itervalues() for p in r)
+
+    def _key_changed(self, km):
+        self.dispatch.pop(km, None)
+        if is_sequence(km):
+            km = km[0]
+
+        if self.pending_keys is None:
+            self._sync_keys((km,))
+        else:
+            self.pending_keys.add(km)
+
+    def _sync_keys(self, keys):
+        for km in keys:
+            if self.shortcuts.get(km) or (km,) in self.sequence_prefixes:
+                if km not in self.connected_keys:
+                    self.connect_key(km)
+                    self.connected_keys.add(km)
+            elif km in self.connected_keys:
+                self.disconnect_key(km)
+                self.connected_keys.discard(km)
+
+    def connect_key(self, km):
+        pass
+
+    def disconnect_key(self, km):
+        pass
+
+    @contextmanager
+    def batch(self):
+        # Defers key connection updates until the outermost batch ends so a
+        # key removed and added back again is not reconnected
+        if self.pending_keys is not None:
+            yield self
+            return
+
+        self.pending_keys = set()
+        try:
+            yield self
+        finally:
+            keys, self.pending_keys = self.pending_keys, None
+            self._sync_keys(keys)
+
+    def _invalidate_action(self, ctx, name):
+        if name[0] == '!':
+            # Dynamic entry params are mapped under derived names
+            self.dispatch.clear()
+        else:
+            for km, _, _ in self.action_keys.get((ctx, name), ()):
+                self.dispatch.pop(km, None)
+
+    def _compile_shortcut(self, km):
+        # Groups actions into priority tiers with cheap contexts first. Static
+        # actions are looked up once, dynamic ones keep their MultiEntry and
+        # param to resolve on activation.
+        tiers = []
+        last_priority = None
+        cost = self.get_context_cost
+        for pr, ctx, name, _ in self.shortcuts.get(km, ()):
+            if pr != last_priority:
+                entries = []
+                tiers.append((pr, entries))
+                last_priority = pr
+
+            actions = self.actions.get(ctx, {})
+            action = actions.get(name)
+            if action is None and name[0] == '!':
+                dname, _, param = name.partition('/')
+                entries.append((ctx, name, None, actions.get(dname), param))
+            else:
+                entries.append((ctx, name, action, None, None))
+
+        for _, entries in tiers:
+            entries.sort(key=lambda r: cost(r[0]))
+
+        self.dispatch[km] = tiers
+        return tiers
+
+    def find_actions(self, km, ctx_getter):
+        # Actions of the top priority tier with available contexts
+        try:
+            tiers = self.dispatch[km]
+        except KeyError:
+            tiers = self._compile_shortcut(km)
+
+        profiler = self.profiler
+        actions = []
+        for _, entries in tiers:
+            for ctx, name, action, dynamic, param in entries:
+                ctx_obj = ctx_getter(ctx)
+                if ctx_obj is None:
+                    continue
+
+                if action is None:
+                    if dynamic is None:
+                        raise KeyError('%s %s' % (ctx, name))
+
+                    if profiler:
+                        t = time()
+                        action = dynamic.resolve(ctx_obj, param)
+                        profiler.add('resolve', time() - t)
+                    else:
+                        action = dynamic.resolve(ctx_obj, param)
+
+                    if not action:
+                        continue
+
+                actions.append(action)
+
+            if actions:
+                break
+
+        return actions
+
+    def _add_generic_shortcuts(self, ctx, name):
+        if name in self.generic_shortcuts:
+            # Rebinding (e.g. replacing a stub) must not duplicate them
+            if any(r[2] for r in self.action_keys.get((ctx, name), ())):
+                return
+
+            for km, priority in self.generic_shortcuts[name]:
+                self._add_shortcut(km, ctx, name, -priority, True)
+
+    def _map(self, ctx, name, accel, priority=None):
+        km, priority = parse_accel(accel, priority)
+        self._add_shortcut(km, ctx, name, -priority, False)
+
+    def map(self, ctx, name, accel, priority=None):
+        assert ctx is not None
+        ctx = normalize_context(ctx)
+        key = ctx, name
+        shortcut = parse_accel(accel, priority)
+        defaults = self.default_shortcuts.setdefault(key, [])
+        if shortcut in defaults:
+            return
+
+        defaults.append(shortcut)
+        if key not in self.changed_shortcuts:
+            self._map(ctx, name, accel, priority)
+
+    def replace_keys(self, ctx, name, keys):
+        key = ctx, name
+        if key in self.default_shortcuts and set(self.default_shortcuts[key]) == set(keys):
+            self.changed_shortcuts.pop(key, None)
+        else:
+            if keys or key in self.default_shortcuts:
+                self.changed_shortcuts[key] = [(accel_name(km), pr) for km, pr in keys]
+            else:
+                self.changed_shortcuts.pop(key, None)
+
+        with self.batch():
+            for km in set(r[0] for r in self.action_keys.pop(key, ())):
+                actions = self.shortcuts[km]
+                if is_sequence(km):
+                    for r in actions:
+                        if r[1] == ctx and r[2] == name:
+                            self._update_sequence_prefixes(km, ctx, r[0], -1)
+
+                actions[:] = [r for r in actions if r[1] != ctx or r[2] != name]
+
+                self._key_changed(km)
+
+            for km, pr in self.generic_shortcuts.get(name, []):
+                self._add_shortcut(km, ctx, name, -pr, True)
+
+            for km, pr in keys:
+                self._add_shortcut(km, ctx, name, -pr, False)
+
+    def get_km_for_action(self, ctx, name):
+        return list(self.action_keys.get((ctx, name), ()))
+
+    def _contexts_changed(self):
+        ContextResolver._contexts_changed(self)
+        self.dispatch.clear()
+
+    def invalidate_context(self, event, window=None):
+        # Dynamic entry caches are not per window and are dropped entirely
+        for ctx, name in self.dynamic_events.get(event, ()):
+            self.actions[ctx][name].invalidate()
+
+        ContextResolver.invalidate_context(self, event, window)
@@ -1,4 +1,8 @@
 import weakref
+from bisect import insort, bisect_left
+from contextlib import contextmanager
+
+from .profiler import get_plugin_name
 
 class Injector(object):
     def __init__(self, activator, plugin_manager):
@@ -8,14 +12,20 @@ class Injector(object):
     def ready(self, name, obj):
         return self.plugin_manager.ready(name, obj)
 
+    def ready_many(self, name, objs):
+        return self.plugin_manager.ready_many(name, objs)
+
     def done(self, name, obj):
         return self.plugin_manager.done(name, obj)
 
-    def on_ready(self, name, callback):
-        return self.plugin_manager.on_ready(name, callback)
+    def batch(self):
+        return self.plugin_manager.batch()
 
-    def on_done(self, name, callback):
-        return self.plugin_manager.on_done(name, callback)
+    def on_ready(self, name, callback, priority=0, weak=False, batch=False):
+        return self.plugin_manager.on_ready(name, callback, priority, weak, batch)
+
+    def on_done(self, name, callback, priority=0, weak=False, batch=False):
+        return self.plugin_manager.on_done(name, callback, priority, weak, batch)
 
     def on(self, *context):
         return self.activator.on(*context)
@@ -26,56 +36,282 @@ class Injector(object):
     def bind_check(self, ctx, name, menu_entry, callback, *args):
         return self.activator.bind_check(ctx, name, menu_entry, callback, *args)
 
+    def bind_many(self, actions):
+        return self.activator.bind_many(actions)
+
     def bind_menu(self, menu_entry):
         return self.activator.bind_menu(menu_entry)
 
-    def bind_dynamic(self, ctx, name, menu_entry, generator, resolver, as_radio=False):
-        return self.activator.bind_dynamic(ctx, name, menu_entry, generator, resolver, as_radio)
+    def bind_dynamic(self, ctx, name, menu_entry, generator, resolver, as_radio=False,
+            cache=False, ttl=None, invalidate_on=None):
+        return self.activator.bind_dynamic(ctx, name, menu_entry, generator, resolver,
+            as_radio, cache, ttl, invalidate_on)
 
     def map(self, ctx, name, accel, priority=None):
         return self.activator.map(ctx, name, accel, priority)
 
-    def add_context(self, ctx, depends, callback):
-        return self.activator.add_context(ctx, depends, callback)
+    def add_context(self, ctx, depends, callback, invalidate_on=None, ttl=None, cost=None):
+        return self.activator.add_context(ctx, depends, callback, invalidate_on, ttl, cost)
+
+    def invalidate_context(self, event, window=None):
+        return self.activator.invalidate_context(event, window)
+
+
+class Subscription(object):
+    """Handle returned by :meth:`EventBus.subscribe`
+
+    Weak subscriptions hold only a weak reference to the callback (or to
+    ``im_self`` of a bound method) and are cancelled when it dies.
+    """
+    def __init__(self, bus, event, callback, priority=0, weak=False, batch=False):
+        self.bus = bus
+        self.event = event
+        self.priority = priority
+        self.batch = batch
+        self.key = None
+
+        if weak:
+            obj = getattr(callback, 'im_self', None)
+            if obj is not None:
+                self.ref = weakref.ref(obj, self._on_dead)
+                self.func = callback.im_func
+            else:
+                self.ref = weakref.ref(callback, self._on_dead)
+                self.func = None
+        else:
+            self.ref = None
+            self.func = callback
+
+    @property
+    def callback(self):
+        if self.ref is None:
+            return self.func
+
+        obj = self.ref()
+        if obj is None or self.func is None:
+            return obj
+
+        return self.func.__get__(obj, type(obj))
+
+    @property
+    def active(self):
+        return self.bus is not None
+
+    def _on_dead(self, ref):
+        self.cancel()
+
+    def cancel(self):
+        if self.bus:
+            self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    def __init__(self):
+        self.subscriptions = {}
+        self.counter = 0
+
+    def subscribe(self, event, callback, priority=0, weak=False, batch=False):
+        sub = Subscription(self, event, callback, priority, weak, batch)
+        # Higher priority first, subscription order within the same priority
+        self.counter += 1
+        sub.key = (-priority, self.counter)
+        insort(self.subscriptions.setdefault(event, []), (sub.key, sub))
+        return sub
+
+    def unsubscribe(self, sub):
+        sub.bus = None
+        subs = self.subscriptions.get(sub.event)
+        if not subs:
+            return
+
+        idx = bisect_left(subs, (sub.key,))
+        if idx < len(subs) and subs[idx][1] is sub:
+            del subs[idx]
+            if not subs:
+                del self.subscriptions[sub.event]
+
+    def get(self, event):
+        return [r[1] for r in self.subscriptions.get(event, ())]
+
+    def emit(self, event, objs, call=None):
+        for sub in self.get(event):
+            deliver(sub, objs, call)
+
+
+def deliver(sub, objs, call=None):
+    # Subscription can be cancelled by previous callbacks
+    if not sub.bus:
+        return
+
+    callback = sub.callback
+    if callback is None:
+        return
+
+    call = call or apply
+    if sub.batch:
+        call(callback, (objs,))
+    else:
+        for obj in objs:
+            call(callback, (obj,))
+
+
+class LazyPlugin(object):
+    """Plugin initialized on first use
+
+    ``init`` is a callable, usually ``utils.lazy_func('.module.init')``.
+    ``actions`` are (ctx, name, menu_entry[, accels]) rows describing
+    actions bound by init. ``ready`` lists names of objects plugin waits
+    for with ``on_ready``.
+    """
+    def __init__(self, init, actions=(), ready=()):
+        self.init_func = init
+        self.actions = actions
+        self.ready = ready
+        self.loaded = False
+
+    def init(self, injector):
+        self.init_func(injector)
 
 
 class Manager(object):
     def __init__(self, activator):
         self.plugins = []
-        self.ready_callbacks = {}
+        self.lazy_ready = {}
         self.ready_objects = {}
-        self.done_callbacks = {}
+        self.pending_ready = None
+        self.events = EventBus()
         self.injector = Injector(activator, self)
+        self.profiler = None
 
-    def add_plugin(self, plugin):
-        self.plugins.append(plugin)
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+
+    def _init_plugin(self, plugin):
         try:
-            plugin.init(self.injector)
+            if self.profiler:
+                self.profiler.run_plugin(get_plugin_name(plugin), plugin.init, self.injector)
+            else:
+                plugin.init(self.injector)
         except:
             import traceback
             traceback.print_exc()
 
+    def _get_call(self, kind, name):
+        if self.profiler:
+            return lambda callback, args: self.profiler.run_callback(kind, name, callback, *args)
+
+        return None
+
+    def add_plugin(self, plugin):
+        self.plugins.append(plugin)
+        if isinstance(plugin, LazyPlugin):
+            self._add_lazy_plugin(plugin)
+            return
+
+        self._init_plugin(plugin)
+
+    def _add_lazy_plugin(self, plugin):
+        activator = self.injector.activator
+        loader = lambda: self.load_plugin(plugin)
+        for row in plugin.actions:
+            ctx, name, menu_entry = row[:3]
+            binder = activator.bind_stub(ctx, name, menu_entry, loader)
+            accels = row[3] if len(row) > 3 else None
+            if isinstance(accels, str):
+                accels = (accels,)
+
+            for accel in accels or ():
+                if isinstance(accel, tuple):
+                    binder.to(*accel)
+                else:
+                    binder.to(accel)
+
+        for name in plugin.ready:
+            self.lazy_ready.setdefault(name, []).append(plugin)
+
+        # Objects are already there, on_ready of loaded plugin gets them
+        if any(self.ready_objects.get(name) for name in plugin.ready):
+            self.load_plugin(plugin)
+
+    def load_plugin(self, plugin):
+        if plugin.loaded:
+            return
+
+        plugin.loaded = True
+        for name in plugin.ready:
+            self.lazy_ready[name].remove(plugin)
+
+        self._init_plugin(plugin)
+
+    def _load_waiting_plugins(self, name):
+        for plugin in self.lazy_ready.get(name, [])[:]:
+            self.load_plugin(plugin)
+
     def ready(self, name, obj):
-        self.ready_objects.setdefault(name, weakref.WeakKeyDictionary())[obj] = True
-        if name in self.ready_callbacks:
-            for c in self.ready_callbacks[name]:
-                c(obj)
+        if self.pending_ready is None:
+            self.ready_many(name, (obj,))
+        else:
+            self.pending_ready.append((name, obj))
+
+    def ready_many(self, name, objs):
+        # Waiting plugins are loaded before objs registration, so their on_ready
+        # callbacks are called with objs exactly once below
+        self._load_waiting_plugins(name)
+
+        objects = self.ready_objects.setdefault(name, weakref.WeakKeyDictionary())
+        for obj in objs:
+            objects[obj] = True
+
+        self.events.emit(('ready', name), list(objs), self._get_call('ready', name))
+
+    @contextmanager
+    def batch(self):
+        """Collects ready() calls and delivers them as one batch per name"""
+        if self.pending_ready is not None:
+            yield
+            return
+
+        self.pending_ready = pending = []
+        try:
+            yield
+        finally:
+            self.pending_ready = None
+
+            names = []
+            objs = {}
+            for name, obj in pending:
+                if name not in objs:
+                    names.append(name)
+                    objs[name] = []
+
+                objs[name].append(obj)
+
+            for name in names:
+                self.ready_many(name, objs[name])
 
     def done(self, name, obj):
+        if self.pending_ready:
+            try:
+                self.pending_ready.remove((name, obj))
+                return
+            except ValueError:
+                pass
+
         try:
             del self.ready_objects[name][obj]
         except KeyError:
             pass
 
-        if name in self.done_callbacks:
-            for c in self.done_callbacks[name]:
-                c(obj)
+        self.events.emit(('done', name), [obj], self._get_call('done', name))
 
-    def on_ready(self, name, callback):
+    def on_ready(self, name, callback, priority=0, weak=False, batch=False):
+        sub = self.events.subscribe(('ready', name), callback, priority, weak, batch)
         if name in self.ready_objects:
-            map(callback, self.ready_objects[name])
+            objs = list(self.ready_objects[name])
+            if objs:
+                deliver(sub, objs, self._get_call('ready', name))
 
-        self.ready_callbacks.setdefault(name, []).append(callback)
+        return sub
 
-    def on_done(self, name, callback):
-        self.done_callbacks.setdefault(name, []).append(callback)
+    def on_done(self, name, callback, priority=0, weak=False, batch=False):
+        return self.events.subscribe(('done', name), callback, priority, weak, batch)
@@ -0,0 +1,230 @@
+import json
+import __builtin__
+from math import frexp
+from time import time
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+
+        if value > self.max:
+            self.max = value
+
+        # Bucket N holds durations below 2**N microseconds
+        bucket = frexp(value * 1000000)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    @property
+    def avg(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'avg': self.avg,
+            'buckets': dict((2 ** k, v) for k, v in self.buckets.iteritems()),
+        }
+
+
+def get_action_key(entry):
+    return '%s:%s' % (','.join(entry.ctx), entry.name or entry.title)
+
+
+class ActionProfiler(object):
+    """Collects activation phase timings per action
+
+    Phases are ``context:<name>`` for each called context provider,
+    ``resolve`` for dynamic entry resolving and ``callback`` for action
+    itself. Attach it with :meth:`uxie.actions.Activator.set_profiler`.
+    """
+    def __init__(self):
+        self.actions = {}
+        self.phases = None
+
+    def start(self):
+        self.phases = []
+
+    def add(self, phase, duration):
+        if self.phases is not None:
+            self.phases.append((phase, duration))
+
+    def finish(self, action):
+        phases, self.phases = self.phases, None
+        if action is None or not phases:
+            return
+
+        stats = self.actions.setdefault(action, {})
+        for phase, duration in phases:
+            try:
+                stats[phase].add(duration)
+            except KeyError:
+                stats[phase] = h = Histogram()
+                h.add(duration)
+
+    def wrap_context(self, ctx, callback):
+        phase = 'context:' + ctx
+        def inner(*args):
+            t = time()
+            try:
+                return callback(*args)
+            finally:
+                self.add(phase, time() - t)
+
+        return inner
+
+    def get(self, action):
+        return self.actions.get(action, {})
+
+    def as_dict(self):
+        return dict((action, dict((phase, h.as_dict()) for phase, h in stats.iteritems()))
+            for action, stats in self.actions.iteritems())
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+class ImportTimer(object):
+    # Accumulates time spent in outermost __import__ calls
+    def __init__(self):
+        self.total = 0.0
+        self.depth = 0
+
+    def __enter__(self):
+        self.orig_import = __builtin__.__import__
+        __builtin__.__import__ = self.do_import
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        __builtin__.__import__ = self.orig_import
+
+    def do_import(self, *args, **kwargs):
+        if self.depth:
+            return self.orig_import(*args, **kwargs)
+
+        self.depth += 1
+        t = time()
+        try:
+            return self.orig_import(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            self.total += time() - t
+
+
+def get_callable_name(func):
+    name = getattr(func, '__name__', None)
+    if not name:
+        return repr(func)
+
+    module = getattr(func, '__module__', None)
+    obj = getattr(func, 'im_self', None)
+    if obj is not None:
+        name = type(obj).__name__ + '.' + name
+
+    return module + '.' + name if module else name
+
+def get_plugin_name(plugin):
+    name = getattr(plugin, 'name', None) or getattr(plugin, '__name__', None)
+    if not name and hasattr(plugin, 'init_func'):
+        name = get_callable_name(plugin.init_func)
+
+    return name or repr(plugin)
+
+
+class StartupProfiler(object):
+    """Records plugin init and ready/done callback timings
+
+    Attach it with :meth:`uxie.plugins.Manager.set_profiler`.
+    """
+    def __init__(self, outlier_factor=3.0, outlier_min=0.01):
+        self.plugins = {}
+        self.callbacks = {}
+        self.outlier_factor = outlier_factor
+        self.outlier_min = outlier_min
+
+    def run_plugin(self, name, func, *args):
+        timer = ImportTimer()
+        t = time()
+        try:
+            with timer:
+                return func(*args)
+        finally:
+            self.plugins[name] = {'wall': time() - t, 'import': timer.total}
+
+    def run_callback(self, kind, name, func, *args):
+        t = time()
+        try:
+            return func(*args)
+        finally:
+            duration = time() - t
+            stats = self.callbacks.setdefault('%s:%s' % (kind, name), {})
+            cname = get_callable_name(func)
+            try:
+                stats[cname].add(duration)
+            except KeyError:
+                stats[cname] = h = Histogram()
+                h.add(duration)
+
+    def get_outliers(self, values):
+        # Values noticeably above the median of their group
+        if not values:
+            return set()
+
+        ordered = sorted(values.itervalues())
+        median = ordered[len(ordered) / 2]
+        limit = max(median * self.outlier_factor, self.outlier_min)
+        return set(k for k, v in values.iteritems() if v > limit)
+
+    def as_dict(self):
+        callbacks = {}
+        for event, stats in self.callbacks.iteritems():
+            callbacks[event] = dict((name, h.as_dict()) for name, h in stats.iteritems())
+
+        return {'plugins': self.plugins, 'callbacks': callbacks}
+
+    def get_report(self):
+        lines = []
+        totals = dict((name, r['wall']) for name, r in self.plugins.iteritems())
+        outliers = self.get_outliers(totals)
+
+        lines.append('Plugins (wall, import):')
+        for name, r in sorted(self.plugins.iteritems(), key=lambda r: -r[1]['wall']):
+            lines.append('%s %8.1fms %8.1fms  %s' % ('!' if name in outliers else ' ',
+                r['wall'] * 1000, r['import'] * 1000, name))
+
+        totals = {}
+        for event, stats in self.callbacks.iteritems():
+            for name, h in stats.iteritems():
+                totals[(event, name)] = h.total
+
+        outliers = self.get_outliers(totals)
+
+        lines.append('')
+        lines.append('Callbacks (total, count, max):')
+        for key, total in sorted(totals.iteritems(), key=lambda r: -r[1]):
+            h = self.callbacks[key[0]][key[1]]
+            lines.append('%s %8.1fms %6d %8.1fms  %s %s' % ('!' if key in outliers else ' ',
+                total * 1000, h.count, h.max * 1000, key[0], key[1]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, filename):
+        with open(filename, 'w') as f:
+            if filename.endswith('.json'):
+                json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            else:
+                f.write(self.get_report())
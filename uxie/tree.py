@@ -77,3 +77,98 @@ class SelectionListStore(gtk.ListStore):
             self.ordered_selection[idx] = newpath
 
         self.emit('selection-changed', self.selection)
+
+
+class VirtualListModel(gtk.GenericTreeModel):
+    """List model over a python sequence of rows
+
+    The view asks for values of visible rows only (use fixed height mode).
+    ``replace`` swaps the whole sequence with one reset instead of per-row
+    signals.
+    """
+    def __init__(self, *types):
+        gtk.GenericTreeModel.__init__(self)
+        # Iters don't hold references, rowrefs are kept alive in self.refs
+        self.props.leak_references = False
+        self.types = types
+        self.rows = []
+        self.refs = []
+
+    def get_ref(self, index):
+        refs = self.refs
+        if index >= len(refs):
+            refs.extend(xrange(len(refs), max(index + 1, len(self.rows))))
+
+        return refs[index]
+
+    def replace(self, view, rows):
+        # Detached view rebuilds its state once on set_model. Rows are
+        # copied, append and clear must not change caller's list.
+        view.set_model(None)
+        self.invalidate_iters()
+        self.rows = list(rows)
+        view.set_model(self)
+
+    # append and clear mimic gtk.ListStore and emit per-row signals
+
+    def append(self, row):
+        self.rows.append(row)
+        path = (len(self.rows) - 1,)
+        self.row_inserted(path, self.get_iter(path))
+
+    def clear(self):
+        while self.rows:
+            self.rows.pop()
+            self.row_deleted((len(self.rows),))
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_LIST_ONLY
+
+    def on_get_n_columns(self):
+        return len(self.types)
+
+    def on_get_column_type(self, index):
+        return self.types[index]
+
+    def on_get_iter(self, path):
+        if path[0] < len(self.rows):
+            return self.get_ref(path[0])
+
+        return None
+
+    def on_get_path(self, rowref):
+        return (rowref,)
+
+    def on_get_value(self, rowref, column):
+        return self.rows[rowref][column]
+
+    def on_iter_next(self, rowref):
+        rowref += 1
+        if rowref < len(self.rows):
+            return self.get_ref(rowref)
+
+        return None
+
+    def on_iter_children(self, parent):
+        if parent is None and self.rows:
+            return self.get_ref(0)
+
+        return None
+
+    def on_iter_has_child(self, rowref):
+        return False
+
+    def on_iter_n_children(self, rowref):
+        if rowref is None:
+            return len(self.rows)
+
+        return 0
+
+    def on_iter_nth_child(self, parent, n):
+        if parent is None and n < len(self.rows):
+            return self.get_ref(n)
+
+        return None
+
+    def on_iter_parent(self, child):
+        return None
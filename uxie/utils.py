@@ -1,5 +1,4 @@
-import os, sys
-from os.path import join, dirname, exists, expanduser
+import sys
 from contextlib import contextmanager
 
 import weakref
@@ -7,6 +6,9 @@ import weakref
 import gobject
 import gtk
 
+from .fs import (join_to_file_dir, join_to_settings_dir, join_to_data_dir,
+    join_to_cache_dir, make_missing_dirs, atomic_open)
+
 def idle_callback(callable, args):
     args, kwargs = args
     callable(*args, **kwargs)
@@ -19,26 +21,6 @@ def idle(callable, *args, **kwargs):
         del kwargs['priority']
     return gobject.idle_add(idle_callback, callable, (args, kwargs), **options)
 
-def join_to_file_dir(filename, *args):
-    return join(dirname(filename), *args)
-
-def join_to_settings_dir(*args):
-    config_dir = os.getenv('XDG_CONFIG_HOME', expanduser('~/.config'))
-    return join(config_dir, *args)
-
-def join_to_data_dir(*args):
-    config_dir = os.getenv('XDG_DATA_HOME', expanduser('~/.local/share'))
-    return join(config_dir, *args)
-
-def join_to_cache_dir(*args):
-    config_dir = os.getenv('XDG_CACHE_HOME', expanduser('~/.cache'))
-    return join(config_dir, *args)
-
-def make_missing_dirs(filename):
-    path = dirname(filename)
-    if not exists(path):
-        os.makedirs(path, mode=0755)
-
 def refresh_gui():
     while gtk.events_pending():
         gtk.main_iteration_do(block=False)
@@ -0,0 +1,168 @@
+import re
+from bisect import bisect_left, insort
+from heapq import nlargest
+from collections import Counter
+
+from .complete import fill_view
+
+WORD_RE = re.compile(r'\w+', re.U)
+PREFIX_RE = re.compile(r'\w+$', re.U)
+LINE_SPLIT_RE = re.compile('\r\n|\r|\n|\xe2\x80\xa9')
+WORD_MIN_LENGTH = 3
+WORD_LIMIT = 50
+PREFIX_MIN_LENGTH = 2
+
+
+class WordIndex(object):
+    """Word frequency index of a gtk.TextBuffer
+
+    Buffer changes rescan only touched lines. Words are kept sorted for
+    prefix search, see :meth:`complete`. :meth:`fill` and :meth:`activate`
+    are callbacks for TextViewCompleter.attach.
+    """
+    def __init__(self, min_length=WORD_MIN_LENGTH, limit=WORD_LIMIT,
+            prefix_length=PREFIX_MIN_LENGTH):
+        self.min_length = min_length
+        self.prefix_length = prefix_length
+        self.limit = limit
+        self.counts = {}
+        self.words = []
+        self.lines = [()]
+        self.buffer = None
+        self.handlers = []
+        self.insert_line = None
+        self.delete_line = None
+
+    def get_words(self, text):
+        min_length = self.min_length
+        return tuple(w for w in WORD_RE.findall(text.decode('utf-8')) if len(w) >= min_length)
+
+    def set_text(self, text):
+        self.lines = [self.get_words(r) for r in LINE_SPLIT_RE.split(text)]
+        counts = Counter()
+        for words in self.lines:
+            counts.update(words)
+
+        self.counts = dict(counts)
+        self.words = sorted(counts)
+
+    def reindex(self, start, removed, texts):
+        # Replaces `removed` lines from `start` with words of `texts` lines
+        old = Counter()
+        for words in self.lines[start:start + removed]:
+            old.update(words)
+
+        lines = [self.get_words(r) for r in texts]
+        new = Counter()
+        for words in lines:
+            new.update(words)
+
+        self.lines[start:start + removed] = lines
+        self.add_words(new - old)
+        self.remove_words(old - new)
+
+    def add_words(self, delta):
+        counts = self.counts
+        for w, c in delta.iteritems():
+            if w not in counts:
+                insort(self.words, w)
+                counts[w] = c
+            else:
+                counts[w] += c
+
+    def remove_words(self, delta):
+        counts = self.counts
+        for w, c in delta.iteritems():
+            c = counts[w] - c
+            if c > 0:
+                counts[w] = c
+            else:
+                del counts[w]
+                del self.words[bisect_left(self.words, w)]
+
+    def complete(self, prefix, limit=None):
+        """Returns most frequent words starting with prefix"""
+        if isinstance(prefix, str):
+            prefix = prefix.decode('utf-8')
+
+        words = self.words
+        candidates = words[bisect_left(words, prefix):bisect_left(words, prefix + u'\uffff')]
+        if candidates and candidates[0] == prefix:
+            del candidates[0]
+
+        return nlargest(limit or self.limit, candidates, key=self.counts.__getitem__)
+
+    def attach(self, buf):
+        self.detach()
+        self.buffer = buf
+        self.set_text(buf.get_text(*buf.get_bounds()))
+        self.handlers = [
+            buf.connect('insert-text', self.on_insert_text),
+            buf.connect_after('insert-text', self.on_after_insert_text),
+            buf.connect('delete-range', self.on_delete_range),
+            buf.connect_after('delete-range', self.on_after_delete_range),
+        ]
+
+    def detach(self):
+        for h in self.handlers:
+            self.buffer.handler_disconnect(h)
+
+        self.handlers = []
+        self.buffer = None
+
+    def get_line_text(self, line):
+        start = self.buffer.get_iter_at_line(line)
+        end = start.copy()
+        if not end.ends_line():
+            end.forward_to_line_end()
+
+        return self.buffer.get_text(start, end)
+
+    def on_insert_text(self, buf, it, text, length):
+        self.insert_line = it.get_line()
+
+    def on_after_insert_text(self, buf, it, text, length):
+        start = self.insert_line
+        added = buf.get_line_count() - len(self.lines)
+        self.reindex(start, 1, [self.get_line_text(r) for r in range(start, start + added + 1)])
+
+    def on_delete_range(self, buf, start, end):
+        self.delete_line = start.get_line()
+
+    def on_after_delete_range(self, buf, start, end):
+        line = self.delete_line
+        removed = len(self.lines) - buf.get_line_count()
+        self.reindex(line, removed + 1, [self.get_line_text(line)])
+
+    def get_prefix(self, textview):
+        buf = textview.get_buffer()
+        end = buf.get_iter_at_mark(buf.get_insert())
+        start = end.copy()
+        start.set_line_offset(0)
+        match = PREFIX_RE.search(buf.get_text(start, end).decode('utf-8'))
+        return match.group() if match else None
+
+    def fill(self, view, textview, check=None, *args):
+        # One char prefixes match too much of a large vocabulary
+        prefix = self.get_prefix(textview)
+        if prefix and len(prefix) >= self.prefix_length:
+            rows = [(w.encode('utf-8'),) for w in self.complete(prefix)]
+        else:
+            rows = []
+
+        fill_view(view, rows)
+
+    def activate(self, view, path, textview, is_final):
+        if not is_final:
+            return
+
+        prefix = self.get_prefix(textview) or u''
+        word = view.get_model()[path][0].decode('utf-8')
+        if word.startswith(prefix):
+            textview.get_buffer().insert_at_cursor(word[len(prefix):].encode('utf-8'))
+
+    def attach_to_completer(self, completer, textview):
+        # Ready made words completion for a TextViewCompleter, view should
+        # have single text column, e.g. create_simple_complete_view()
+        self.attach(textview.get_buffer())
+        completer.attach(textview, self.fill, self.activate)